@@ -0,0 +1,315 @@
+import time
+import socket
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Callbacks as AMI Originate actions instead of call files:
+# [autodial_marks]
+# dispatch_backend = ami     ; callfile by default
+# [ami]
+# host = 127.0.0.1
+# port = 5038
+# username = autodial
+# secret = ...
+# connect_timeout = 5
+# response_timeout = 5       ; seconds to wait for "Originate successfully queued"
+# result_timeout = 300       ; OriginateResponse not seen after this long is forgotten
+#
+# The manager user needs write=originate and read=call in manager.conf: OriginateResponse is a call class event.
+
+class AmiError(Exception):
+    pass
+
+def render_action(fields):
+    return ''.join(f"{key}: {value}\r\n" for key, value in fields) + '\r\n'
+
+def parse_message(block):
+    # Repeated headers keep the last value, none of the ones read here repeat
+    message = {}
+    for line in block.split('\r\n'):
+        key, separator, value = line.partition(':')
+        if separator:
+            message[key.strip()] = value.strip()
+    return message
+
+class AmiClient:
+    # One persistent manager session shared by all handlers. Actions are written without waiting for the
+    # previous response and matched back by ActionID on a reader thread, which also hands events to on_event.
+    def __init__(self, logger, host='127.0.0.1', port=5038, username='', secret='', connect_timeout=5,
+                 response_timeout=5, retries=3, backoff=1, max_backoff=30, on_event=None):
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.username = username
+        self.secret = secret
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_event = on_event
+        self.sock = None
+        self.lock = threading.Lock()
+        # ActionID -> (socket it was written to, Future of the response)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.id_prefix = f"autodial-{socket.gethostname()}-{id(self):x}"
+        self.ids = itertools.count(1)
+        self.connects = 0
+
+    def connection(self):
+        # Caller holds self.lock
+        if self.sock is None:
+            self.sock = self.retry(self.connect)
+            self.connects += 1
+        return self.sock
+
+    def retry(self, action):
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                return action()
+            except (OSError, AmiError) as e:
+                if attempt == self.retries:
+                    self.logger.error(f"AMI connection to {self.host}:{self.port} failed after {attempt} attempts: {e}")
+                    raise
+                self.logger.warning(f"AMI connection attempt {attempt}/{self.retries} failed, retrying in {delay}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        try:
+            reader = sock.makefile('rb')
+            banner = reader.readline().decode(errors='replace').strip()
+            if not banner.startswith('Asterisk Call Manager'):
+                raise AmiError(f"unexpected banner {banner!r}")
+            sock.settimeout(None)
+            threading.Thread(target=self.read_loop, args=(sock, reader), name='ami-reader', daemon=True).start()
+
+            action_id, future = self.write(sock, [[
+                ('Action', 'Login'), ('Username', self.username), ('Secret', self.secret), ('Events', 'call'),
+            ]])[0]
+            response = self.result(action_id, future, self.connect_timeout)
+            if response.get('Response') != 'Success':
+                raise AmiError(f"login rejected: {response.get('Message')}")
+        except (OSError, AmiError):
+            sock.close()
+            raise
+        self.logger.info(f"AMI connected to {self.host}:{self.port} ({banner})")
+        return sock
+
+    def write(self, sock, actions, before_write=None):
+        # The whole batch goes out in one sendall, responses come back in any order.
+        # before_write gets the ActionIDs first, so events answering them cannot arrive ahead of the caller
+        sent = []
+        for fields in actions:
+            action_id = f"{self.id_prefix}-{next(self.ids)}"
+            future = Future()
+            with self.pending_lock:
+                self.pending[action_id] = (sock, future)
+            sent.append((action_id, future, render_action(list(fields) + [('ActionID', action_id)])))
+        if before_write:
+            before_write([action_id for action_id, _, _ in sent])
+        try:
+            sock.sendall(''.join(payload for _, _, payload in sent).encode())
+        except OSError as e:
+            self.disconnect(sock, e)
+            raise
+        return [(action_id, future) for action_id, future, _ in sent]
+
+    def send(self, actions, before_write=None):
+        # [(action_id, Future)] in the order of actions, each resolved with the response message
+        with self.lock:
+            return self.write(self.connection(), actions, before_write)
+
+    def result(self, action_id, future, timeout=None):
+        timeout = self.response_timeout if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self.pending_lock:
+                sock, _ = self.pending.pop(action_id, (None, None))
+            # A session that stopped answering (half-open TCP) would time out every later batch as well,
+            # so it is dropped and the next send() connects again
+            if sock is not None:
+                self.disconnect(sock, f"no response to {action_id} in {timeout}s")
+            raise AmiError(f"no response to {action_id}")
+
+    def read_loop(self, sock, reader):
+        block = []
+        try:
+            for raw in reader:
+                line = raw.decode(errors='replace').rstrip('\r\n')
+                if line:
+                    block.append(line)
+                    continue
+                if block:
+                    self.dispatch(parse_message('\r\n'.join(block)))
+                    block = []
+            error = AmiError('connection closed by Asterisk')
+        except OSError as e:
+            error = e
+        self.disconnect(sock, error)
+
+    def dispatch(self, message):
+        if 'Response' in message and 'Event' not in message:
+            with self.pending_lock:
+                _, future = self.pending.pop(message.get('ActionID'), (None, None))
+            if future:
+                future.set_result(message)
+            return
+        if self.on_event:
+            try:
+                self.on_event(message)
+            except Exception as e:
+                self.logger.error(f"AMI event handler failed on {message.get('Event')}: {e}")
+
+    def disconnect(self, sock, error):
+        # Actions still waiting on this socket fail at once, the next send() connects again
+        if self.sock is sock:
+            self.sock = None
+            self.logger.warning(f"AMI connection to {self.host}:{self.port} lost: {error}")
+        try:
+            sock.close()
+        except OSError:
+            pass
+        with self.pending_lock:
+            lost = [action_id for action_id, (action_sock, _) in self.pending.items() if action_sock is sock]
+            futures = [self.pending.pop(action_id)[1] for action_id in lost]
+        for future in futures:
+            if not future.done():
+                future.set_exception(AmiError(f"connection lost: {error}"))
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+            if sock is None:
+                return
+            try:
+                sock.sendall(render_action([('Action', 'Logoff')]).encode())
+            except OSError:
+                pass
+            self.disconnect(sock, 'closed')
+
+class AmiOriginator:
+    # Dispatch backend with the same fields as a call file. A call counts as dispatched once Asterisk queues
+    # the Originate; the OriginateResponse that follows is matched to its evaluated_call_id through the ActionID.
+    header_names = {'Channel': 'Channel', 'Context': 'Context', 'Extension': 'Exten', 'Priority': 'Priority',
+                    'Callerid': 'CallerID', 'Setvar': 'Variable'}
+
+    def __init__(self, client, logger, metrics=None, result_timeout=300, on_result=None):
+        self.client = client
+        self.client.on_event = self.on_event
+        self.logger = logger
+        self.metrics = metrics
+        self.result_timeout = result_timeout
+        self.on_result = on_result
+        # ActionID -> (evaluated_call_id, sent at)
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, logger, metrics=None, section='ami'):
+        client = AmiClient(
+            logger,
+            host=config.get(section, 'host', fallback='127.0.0.1'),
+            port=config.getint(section, 'port', fallback=5038),
+            username=config.get(section, 'username', fallback=''),
+            secret=config.get(section, 'secret', fallback=''),
+            connect_timeout=config.getfloat(section, 'connect_timeout', fallback=5),
+            response_timeout=config.getfloat(section, 'response_timeout', fallback=5)
+        )
+        return cls(client, logger, metrics, result_timeout=config.getfloat(section, 'result_timeout', fallback=300))
+
+    def originate_action(self, fields):
+        # MaxRetries/RetryTime have no AMI counterpart, WaitTime becomes Timeout in milliseconds
+        action = [('Action', 'Originate'), ('Async', 'true')]
+        for key, value in fields:
+            if key == 'WaitTime':
+                action.append(('Timeout', int(value) * 1000))
+            elif key in self.header_names:
+                action.append((self.header_names[key], value))
+        return action
+
+    def originate_batch(self, calls):
+        # calls: [(evaluated_call_id, call file fields)], returns the evaluated_call_ids Asterisk accepted
+        if not calls:
+            return []
+        self.forget_stale()
+        registered = []
+
+        def register(action_ids):
+            # Before the write: the OriginateResponse may follow "queued" before send() returns
+            now = time.monotonic()
+            with self.lock:
+                for action_id, (callid, _) in zip(action_ids, calls):
+                    self.calls[action_id] = (callid, now)
+            registered.extend(action_ids)
+
+        try:
+            sent = self.client.send([self.originate_action(fields) for _, fields in calls], register)
+        except (OSError, AmiError) as e:
+            with self.lock:
+                for action_id in registered:
+                    self.calls.pop(action_id, None)
+            self.logger.error(f"Failed to send {len(calls)} Originate actions: {e}")
+            self.count('error', len(calls))
+            return []
+
+        accepted = []
+        for (action_id, future), (callid, _) in zip(sent, calls):
+            try:
+                response = self.client.result(action_id, future)
+            except AmiError as e:
+                response = {'Response': 'Error', 'Message': str(e)}
+            if response.get('Response') == 'Success':
+                accepted.append(callid)
+                self.logger.info("Originate queued for call %s", callid)
+                continue
+            with self.lock:
+                self.calls.pop(action_id, None)
+            self.logger.error(f"Originate rejected for call {callid}: {response.get('Message')}")
+            self.count('rejected')
+        self.count('queued', len(accepted))
+        return accepted
+
+    def on_event(self, message):
+        if message.get('Event') != 'OriginateResponse':
+            return
+        with self.lock:
+            call = self.calls.pop(message.get('ActionID'), None)
+        if call is None:
+            return
+        callid, _ = call
+        if message.get('Response') == 'Success':
+            self.logger.info("Call %s answered on %s", callid, message.get('Channel'))
+            self.count('answered')
+        else:
+            # Reason is the AST_CONTROL code: 1 hangup, 3 no answer, 5 busy, 8 congestion
+            self.logger.warning(f"Call {callid} failed to originate, reason {message.get('Reason')}")
+            self.count('failed')
+        if self.on_result:
+            self.on_result(callid, message)
+
+    def forget_stale(self):
+        cutoff = time.monotonic() - self.result_timeout
+        with self.lock:
+            stale = [action_id for action_id, (_, sent_at) in self.calls.items() if sent_at < cutoff]
+            for action_id in stale:
+                del self.calls[action_id]
+        if stale:
+            self.logger.warning(f"No OriginateResponse for {len(stale)} calls after {self.result_timeout}s")
+
+    def count(self, result, value=1):
+        if self.metrics and value:
+            self.metrics.inc('autodial_originate_total', value, result=result)
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            metrics.set('autodial_originate_in_flight', len(self.calls))
+        metrics.set('autodial_ami_connects', self.client.connects)
+
+    def close(self):
+        self.client.close()
@@ -1,48 +1,107 @@
-import pandas as pd
 import os
-from pydub import AudioSegment
+import csv
+import argparse
+from simple_audio_convert import ENGINES, ConvertManifest, convert_files
 
-# Загрузите таблицу с именами файлов с указанием правильного разделителя
+# Таблица с именами файлов: старое имя;новое имя
 file_path = '/home/Vladislav.Kozyrev/testsur.csv'
-df = pd.read_csv(file_path, delimiter=';', header=None, names=['Old Name', 'New Name'])
 
-# Проверьте заголовки таблицы
-print("Заголовки таблицы:", df.columns)
-
-# Конвертируем значения колонок в строки
-df['Old Name'] = df['Old Name'].astype(str) + '.m4a'
-df['New Name'] = df['New Name'].astype(str) + '.wav'
-
-# Путь к папке с файлами (замените 'path/to/your/files' на реальный путь)
+# Путь к папке с файлами
 folder_path = '/home/Vladislav.Kozyrev/sur/'
 
 # Папка для сохранения конвертированных файлов
 output_folder = '/home/Vladislav.Kozyrev/newsur/'
-os.makedirs(output_folder, exist_ok=True)
 
-# Итерация по строкам таблицы, переименование и конвертация файлов
-for index, row in df.iterrows():
-    old_name = row['Old Name']  # Колонка с текущими именами файлов
-    new_name = row['New Name']  # Колонка с новыми именами файлов
+def read_mapping(file_path, delimiter=';'):
+    # Таблица читается построчно, целиком в памяти не держится
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        for line_number, row in enumerate(csv.reader(f, delimiter=delimiter), 1):
+            if not any(cell.strip() for cell in row):
+                continue
+            if len(row) < 2:
+                print(f"Line {line_number}: expected 'old name{delimiter}new name', got {row}")
+                continue
+            yield line_number, row[0].strip() + '.m4a', row[1].strip() + '.wav'
+
+def validate_mapping(mapping, folder_path, output_folder):
+    # Один проход по папке с исходниками вместо FileNotFoundError на каждой строке
+    available = {entry.name for entry in os.scandir(folder_path) if entry.is_file()}
+
+    tasks = []
+    problems = 0
+    sources = {}
+    targets = {}
+    for line_number, old_name, new_name in mapping:
+        if old_name not in available:
+            print(f"File {old_name} not found (line {line_number})")
+            problems += 1
+            continue
+        if new_name in targets:
+            print(f"Line {line_number}: {new_name} is already produced from line {targets[new_name]}, skipped")
+            problems += 1
+            continue
+        if old_name in sources:
+            print(f"Line {line_number}: {old_name} is already used on line {sources[old_name]}")
+
+        sources.setdefault(old_name, line_number)
+        targets[new_name] = line_number
+        tasks.append((os.path.join(folder_path, old_name), os.path.join(output_folder, new_name)))
+    return tasks, problems
+
+def print_progress(done, total, old_file_path, new_file_path, error):
+    if error:
+        print(f"[{done}/{total}] Error processing file {os.path.basename(old_file_path)}: {error}")
+    else:
+        print(f"[{done}/{total}] File {os.path.basename(old_file_path)} converted and renamed to {os.path.basename(new_file_path)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rename and convert operator name prompts by a CSV mapping")
+    parser.add_argument('--csv', default=file_path)
+    parser.add_argument('--source', default=folder_path)
+    parser.add_argument('--output', default=output_folder)
+    parser.add_argument('--delimiter', default=';')
+    parser.add_argument('--workers', type=int, default=None)
+    # Движок конвертации: 'pydub', 'ffmpeg' (потоковый, без загрузки файла в память) или 'wav'
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='pydub')
+    parser.add_argument('--incremental', action='store_true',
+                        help="пропускать неизменившиеся файлы по манифесту и удалять результаты без исходника")
+    # После конвертации записать соответствия номер оператора -> файл в operator_name_audio
+    parser.add_argument('--sync-db', action='store_true')
+    parser.add_argument('--config', default='/opt/pydialer/config.ini')
+    parser.add_argument('--sounds-dir', default=None, help="папка звуков Asterisk, по умолчанию /var/lib/asterisk/sounds")
+    parser.add_argument('--sounds-prefix', default='', help="путь к файлам относительно папки звуков, например custom/operators")
+    args = parser.parse_args()
+
+    if args.sync_db:
+        import operator_audio_sync
+
+        # Строки в базе указывают на sounds_dir/prefix/<номер>, поэтому конвертировать нужно прямо туда
+        sounds_dir = args.sounds_dir or operator_audio_sync.sounds_dir
+        target = operator_audio_sync.prompt_dir(sounds_dir, args.sounds_prefix)
+        if os.path.realpath(args.output) != target:
+            parser.error(f"--sync-db needs --output {target}, the directory Asterisk plays the prompts from")
 
-    old_file_path = os.path.join(folder_path, old_name)
-    new_file_path = os.path.join(output_folder, new_name)
+    os.makedirs(args.output, exist_ok=True)
 
-    # Переименование и конвертация файла
-    try:
-        # Загрузка аудиофайла
-        audio = AudioSegment.from_file(old_file_path)
+    tasks, problems = validate_mapping(read_mapping(args.csv, args.delimiter), args.source, args.output)
+    print(f"Rows to convert: {len(tasks)}, problems: {problems}")
 
-        # Конвертация в моно, 8000 Гц, 16-бит
-        audio = audio.set_frame_rate(8000).set_channels(1).set_sample_width(2)
+    # С --incremental манифест в выходной папке: неизменившиеся файлы не конвертируются повторно,
+    # а результаты, у которых пропал исходник, удаляются
+    manifest = None
+    if args.incremental:
+        manifest = ConvertManifest(args.output)
+        for output_path in manifest.prune(args.output):
+            print(f"Removed {output_path}, source file is gone")
 
-        # Сохранение конвертированного файла в формате WAV
-        audio.export(new_file_path, format='wav')
+    results = convert_files(tasks, args.workers, print_progress, manifest, engine=args.engine)
 
-        print(f"File {old_name} converted and renamed to {new_name}")
-    except FileNotFoundError:
-        print(f"File {old_name} not found")
-    except Exception as e:
-        print(f"Error processing file {old_name}: {e}")
+    print("Conversion and renaming completed.")
 
-print("Conversion and renaming completed.")
+    if args.sync_db:
+        # Пропущенные по манифесту файлы тоже синхронизируются, в базу не попадают только ошибки этого прогона
+        failed = {output_path for _, output_path, error in results if error}
+        outputs = [output_path for _, output_path in tasks if output_path not in failed and os.path.exists(output_path)]
+        con = operator_audio_sync.connect(args.config)
+        with con:
+            operator_audio_sync.sync_operator_audio(con, outputs, args.sounds_prefix, sounds_dir)
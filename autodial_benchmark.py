@@ -0,0 +1,508 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import shutil
+import timeit
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timedelta
+import pymysql
+import autodial_marks_oop
+from autodial_marks_oop import Autodialer, CallProcess, OperatorPrefixes
+from ami_dispatch import AmiClient, AmiOriginator, parse_message
+
+def legacy_assign_operators_to_numbers(detail_information):
+    # assign_operators_to_numbers before the prefix registry, kept as the baseline
+    updated_information = []
+    for detail in detail_information:
+        client_number = detail['client_number']
+        if client_number.startswith(('+38066', '+38095', '+38050')):
+            oper = 'mts'
+        elif client_number.startswith(('+38067', '+38068', '+38096', '+38097', '+38098')):
+            oper = 'ks'
+        elif client_number.startswith(('+38063', '+38073', '+38093')):
+            oper = 'life'
+        else:
+            oper = 'unknown'
+
+        updated_detail = detail.copy()
+        updated_detail['oper'] = oper
+        updated_information.append(updated_detail)
+
+    return updated_information
+
+def random_numbers(count, seed=1):
+    rnd = random.Random(seed)
+    codes = ['66', '95', '50', '67', '68', '96', '97', '98', '63', '73', '93', '44', '99']
+    return [f"+380{rnd.choice(codes)}{rnd.randrange(10 ** 7):07d}" for _ in range(count)]
+
+def bench_operator_prefixes(count, repeat):
+    numbers = random_numbers(count)
+    rows = [{'client_number': number} for number in numbers]
+    prefixes = OperatorPrefixes()
+    call_process = CallProcess(None, None, None, prefixes)
+
+    expected = [row['oper'] for row in legacy_assign_operators_to_numbers(rows)]
+    if [row['oper'] for row in call_process.assign_operators_to_numbers(rows)] != expected:
+        raise AssertionError("Prefix registry disagrees with the legacy classifier")
+    if prefixes.classify_many(numbers) != expected:
+        raise AssertionError("classify_many disagrees with the legacy classifier")
+
+    legacy = min(timeit.repeat(lambda: legacy_assign_operators_to_numbers(rows), number=1, repeat=repeat))
+    registry = min(timeit.repeat(lambda: call_process.assign_operators_to_numbers(rows), number=1, repeat=repeat))
+    vectorized = min(timeit.repeat(lambda: prefixes.classify_many(numbers), number=1, repeat=repeat))
+
+    return {
+        'benchmark': 'operator_prefixes',
+        'numbers': count,
+        'legacy_s': legacy,
+        'assign_operators_s': registry,
+        'classify_many_s': vectorized,
+        'speedup_assign': legacy / registry,
+        'speedup_classify_many': legacy / vectorized,
+    }
+
+# Synthetic workload for Autodialer.process_marks against a dedicated MySQL/MariaDB database.
+# The statements are MySQL specific (NOW() - INTERVAL, BIT_XOR/CRC32, SKIP LOCKED), so there is no sqlite mode.
+BENCH_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS departaments (
+        id INT AUTO_INCREMENT PRIMARY KEY, name VARCHAR(64) NOT NULL, callerid VARCHAR(32) NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS operator_marks_setting (
+        id INT AUTO_INCREMENT PRIMARY KEY, calls_type VARCHAR(32) NOT NULL, enable TINYINT, dep_name VARCHAR(64),
+        sleeptime INT DEFAULT 0, steps INT DEFAULT 1, ivr_branch VARCHAR(64), say_fio TINYINT DEFAULT 0,
+        agent_shift_start TIME, agent_shift_end TIME, never_call_after TIME)""",
+    """CREATE TABLE IF NOT EXISTS config_queue_callbacks (queue_name VARCHAR(64) PRIMARY KEY, mark_ivr_menu VARCHAR(64))""",
+    """CREATE TABLE IF NOT EXISTS config_agent_marks (sip VARCHAR(32) PRIMARY KEY, queue_ivr_branch VARCHAR(64))""",
+    """CREATE TABLE IF NOT EXISTS operator_name_audio (
+        operator_number VARCHAR(32) NOT NULL, audio_filename VARCHAR(255), UNIQUE KEY uq_operator_number (operator_number))""",
+    """CREATE TABLE IF NOT EXISTS autodial_marks (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY, calldate DATETIME NOT NULL, client_number VARCHAR(32) NOT NULL,
+        operator_number VARCHAR(32), billsec INT DEFAULT 0, queue VARCHAR(64), uniqueid VARCHAR(64),
+        recordingfile VARCHAR(255), mark_type VARCHAR(32) NOT NULL, callback_status VARCHAR(16) NOT NULL DEFAULT 'NEW',
+        worker_id VARCHAR(64) NULL, claimed_at DATETIME NULL,
+        INDEX idx_marks_new_window (mark_type, callback_status, calldate, client_number, id),
+        INDEX idx_marks_new_id (mark_type, callback_status, id))""",
+    """CREATE TABLE IF NOT EXISTS operator_marks (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY, calldate DATETIME, client_number VARCHAR(32), operator_number VARCHAR(32),
+        billsec INT, queue VARCHAR(64), evaluated_call_id BIGINT, mark_type VARCHAR(32), recordingfile VARCHAR(255),
+        call_attempts INT NOT NULL DEFAULT 0, callback_status VARCHAR(16) NOT NULL DEFAULT 'NEW', date_callback DATETIME NULL,
+        INDEX idx_operator_marks_redial (call_attempts, date_callback))""",
+]
+BENCH_TABLES = ['operator_marks', 'autodial_marks', 'operator_name_audio', 'config_agent_marks',
+                'config_queue_callbacks', 'operator_marks_setting', 'departaments']
+MARK_TYPES = ('incoming', 'manual_out', 'last_call', 'last_call_out')
+
+# Free SIMs handed out by the calc_free_sim stand-in on every call
+capacity_profiles = {
+    'unlimited': {'mts': 1000, 'ks': 1000, 'life': 1000, 'all': 1000, 'all_trunk': 0, 'trunk_enable': False},
+    'office': {'mts': 4, 'ks': 4, 'life': 4, 'all': 8, 'all_trunk': 0, 'trunk_enable': False},
+    'trunk': {'mts': 0, 'ks': 0, 'life': 0, 'all': 2, 'all_trunk': 30, 'trunk_enable': True},
+    'none': {'mts': 0, 'ks': 0, 'life': 0, 'all': 0, 'all_trunk': 0, 'trunk_enable': False},
+}
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def mark_rows(count, mark_type, status, calldates, rnd):
+    numbers = random_numbers(count, rnd.random())
+    return [(
+        calldates(index), number, str(100 + rnd.randrange(20)), rnd.randrange(600), 'q1',
+        f"bench.{mark_type}.{index}", 'bench.wav', mark_type, status
+    ) for index, number in enumerate(numbers)]
+
+def insert_marks(con, rows, batch=10000):
+    with con.cursor() as cur:
+        for start in range(0, len(rows), batch):
+            cur.executemany("""
+                INSERT INTO autodial_marks (calldate, client_number, operator_number, billsec, queue, uniqueid, recordingfile, mark_type, callback_status)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, rows[start:start + batch])
+    con.commit()
+
+def seed_database(con, rows, new_rows, redials, sleeptime, last_call_window, seed=1):
+    rnd = random.Random(seed)
+    with con.cursor() as cur:
+        for table in BENCH_TABLES:
+            cur.execute(f"DROP TABLE IF EXISTS `{table}`")
+        for statement in BENCH_SCHEMA:
+            cur.execute(statement)
+        cur.execute("INSERT INTO departaments (name, callerid) VALUES ('bench', '0800000000')")
+        for call_type in MARK_TYPES:
+            cur.execute("""
+                INSERT INTO operator_marks_setting (calls_type, enable, dep_name, sleeptime, ivr_branch, say_fio,
+                                                    agent_shift_start, agent_shift_end, never_call_after)
+                VALUES (%s, 1, 'bench', %s, 'support', 1, '08:00:00', '20:00:00', '21:00:00')
+            """, (call_type, sleeptime))
+        cur.execute("INSERT INTO config_queue_callbacks VALUES ('q1', 'support')")
+        cur.executemany("INSERT INTO config_agent_marks VALUES (%s, 'sales')", [(str(100 + sip),) for sip in range(20)])
+        cur.executemany("INSERT INTO operator_name_audio VALUES (%s, %s)", [(str(100 + sip), f"operators/{100 + sip}") for sip in range(20)])
+    con.commit()
+
+    # History the dispatcher has to scan past, spread over the last 90 days
+    now = datetime.now()
+    per_type = rows // len(MARK_TYPES)
+    for mark_type in MARK_TYPES:
+        insert_marks(con, mark_rows(per_type, mark_type, 'PROCESSED', lambda index: now - timedelta(seconds=rnd.randrange(90 * 86400)), rnd))
+
+    # Backlog that is already due; last_call marks only count inside the current calling window
+    per_type = new_rows // len(MARK_TYPES)
+    for mark_type in ('incoming', 'manual_out'):
+        insert_marks(con, mark_rows(per_type, mark_type, 'NEW', lambda index: now - timedelta(seconds=sleeptime + rnd.randrange(3600)), rnd))
+    if last_call_window:
+        start, end = (datetime.strptime(value, '%Y-%m-%d %H:%M:%S') for value in last_call_window)
+        span = max(int((end - start).total_seconds()), 1)
+        for mark_type in ('last_call', 'last_call_out'):
+            insert_marks(con, mark_rows(per_type, mark_type, 'NEW', lambda index: start + timedelta(seconds=rnd.randrange(span)), rnd))
+
+    with con.cursor() as cur:
+        cur.execute("""
+            INSERT INTO operator_marks (calldate, client_number, operator_number, billsec, queue, evaluated_call_id, mark_type,
+                                        recordingfile, call_attempts, callback_status, date_callback)
+            SELECT calldate, client_number, operator_number, billsec, queue, id, mark_type, recordingfile, 1, 'NOANSWER',
+                   NOW() - INTERVAL 1 HOUR
+            FROM autodial_marks WHERE callback_status = 'PROCESSED' AND mark_type IN ('incoming', 'manual_out')
+            ORDER BY id LIMIT %s
+        """, (redials,))
+    con.commit()
+
+def bench_workload(args):
+    connect_args = dict(host=args.host, port=args.port, user=args.user, password=args.password, database=args.database,
+                        charset='utf8', cursorclass=pymysql.cursors.DictCursor)
+    workdir = tempfile.mkdtemp(prefix='autodial-bench-')
+    try:
+        config_path = os.path.join(workdir, 'config.ini')
+        with open(config_path, 'w') as f:
+            f.write(f"""[mysql]
+host = {args.host}
+port = {args.port}
+user = {args.user}
+password = {args.password}
+database = {args.database}
+
+[autodial_marks]
+batch_dispatch = {args.batch}
+concurrent_handlers = {args.concurrent}
+incremental_marks = {args.incremental}
+redial_batch_size = 500
+
+[metrics]
+enabled = true
+
+[logging]
+console = false
+""")
+
+        settings = {'agent_shift_start': '08:00:00', 'agent_shift_end': '20:00:00', 'never_call_after': '21:00:00'}
+        last_call_window = autodial_marks_oop.LastCallHandler(None, None, None).get_time_range(settings)
+        last_call_window = last_call_window if all(last_call_window) else None
+
+        loader = pymysql.connect(autocommit=False, **connect_args)
+        if args.seed:
+            seed_started = time.perf_counter()
+            seed_database(loader, args.seed, args.backlog, args.redials, args.sleeptime, last_call_window)
+            seed_seconds = time.perf_counter() - seed_started
+        else:
+            seed_seconds = 0
+
+        # calc_free_sim is replaced for the whole module, the profile is returned on every call
+        profile = capacity_profiles[args.capacity]
+        autodial_marks_oop.calc_free_sim = lambda cur, dep_id, print_log, logger: dict(profile)
+
+        autodialer = Autodialer(config_path)
+        call_process = autodialer.call_process
+        call_process.call_file_dir = call_process.spool.staging_dir = os.path.join(workdir, 'call')
+        call_process.asterisk_outgoing = call_process.spool.outgoing_dir = call_process.spool_monitor.outgoing_dir = os.path.join(workdir, 'outgoing')
+        call_process.spool.fsync = args.fsync
+        os.makedirs(call_process.spool.staging_dir)
+        os.makedirs(call_process.spool.outgoing_dir)
+
+        # A dispatch path that only logs its failures would still produce plausible timings, so errors are kept
+        errors = []
+        log_error = autodialer.logger.error
+        def record_error(message, *args, **fields):
+            errors.append(message % args if args else message)
+            log_error(message, *args, **fields)
+        autodialer.logger.error = record_error
+
+        with loader.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS n FROM operator_marks")
+            operator_marks_before = cur.fetchone()['n']
+        loader.commit()
+
+        # First time each mark id reaches the spool
+        spooled = {}
+        make_call_files = call_process.make_call_files
+        def record_spooled(calls):
+            written = make_call_files(calls)
+            spooled_at = time.time()
+            for callid in written:
+                spooled.setdefault(callid, spooled_at)
+            return written
+        call_process.make_call_files = record_spooled
+
+        # Live marks arrive at --rate per second while the dispatcher runs; only these have a meaningful latency
+        rnd = random.Random(2)
+        due = {}
+        tick_seconds = []
+        dispatched = 0
+        queries_before = autodialer.metrics.total('autodial_db_query_seconds')
+        started = time.perf_counter()
+        deadline = started + args.duration
+        arrived = 0
+        while time.perf_counter() < deadline:
+            expected = int((time.perf_counter() - started) * args.rate)
+            if expected > arrived:
+                calldate = datetime.now().replace(microsecond=0)
+                rows = mark_rows(expected - arrived, rnd.choice(('incoming', 'manual_out')), 'NEW', lambda index: calldate, rnd)
+                with loader.cursor() as cur:
+                    for row in rows:
+                        cur.execute("""
+                            INSERT INTO autodial_marks (calldate, client_number, operator_number, billsec, queue, uniqueid, recordingfile, mark_type, callback_status)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        """, row)
+                        due[cur.lastrowid] = calldate.timestamp() + args.sleeptime
+                loader.commit()
+                arrived = expected
+
+            tick_started = time.perf_counter()
+            with autodialer.con.cursor() as cur:
+                dispatched += autodialer.process_marks(cur)
+            tick_seconds.append(time.perf_counter() - tick_started)
+            # Asterisk picks call files up at once, otherwise the spool monitor holds their numbers back
+            for entry in os.scandir(call_process.spool.outgoing_dir):
+                os.unlink(entry.path)
+        elapsed = time.perf_counter() - started
+        queries = autodialer.metrics.total('autodial_db_query_seconds') - queries_before
+
+        latencies = [spooled[mark_id] - due_at for mark_id, due_at in due.items() if mark_id in spooled]
+        loader.commit()
+        with loader.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS n FROM operator_marks")
+            operator_marks_rows = cur.fetchone()['n'] - operator_marks_before
+        loader.close()
+        autodialer.logger.close()
+        if errors:
+            raise AssertionError(f"Dispatch logged {len(errors)} errors, first: {errors[0]}")
+        if not operator_marks_rows:
+            raise AssertionError(f"No rows reached operator_marks, {dispatched} calls reported as dispatched")
+        return {
+            'benchmark': 'workload',
+            'seed_rows': args.seed,
+            'seed_s': seed_seconds,
+            'backlog_rows': args.backlog,
+            'redial_rows': args.redials,
+            'last_call_window': list(last_call_window) if last_call_window else None,
+            'capacity': args.capacity,
+            'batch_dispatch': args.batch,
+            'concurrent_handlers': args.concurrent,
+            'incremental_marks': args.incremental,
+            'duration_s': elapsed,
+            'ticks': len(tick_seconds),
+            'tick_p50_s': percentile(tick_seconds, 0.5),
+            'tick_p99_s': percentile(tick_seconds, 0.99),
+            'dispatched': dispatched,
+            'callbacks_per_s': dispatched / elapsed if elapsed else 0,
+            'live_marks': len(due),
+            'live_dispatched': len(latencies),
+            'operator_marks_rows': operator_marks_rows,
+            'latency_p50_s': percentile(latencies, 0.5),
+            'latency_p99_s': percentile(latencies, 0.99),
+            'queries': queries,
+            'queries_per_call': queries / dispatched if dispatched else None,
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+class FakeAmiServer:
+    # Local manager for the ami benchmark. Responses to a batch come back in reverse order once `batch`
+    # actions have arrived, so a client that waits for each response before sending the next never gets one.
+    # The OriginateResponse of every call follows its "queued" response at once, in the same write.
+    def __init__(self, batch, failing=()):
+        self.batch = batch
+        self.failing = set(failing)
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        self.connections = []
+        self.originates = 0
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections.append(sock)
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def drop(self):
+        # Like Asterisk restarting: every open session is closed
+        for sock in self.connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connections = []
+
+    def close(self):
+        self.drop()
+        self.server.close()
+
+    def serve(self, sock):
+        buffer = b''
+        queued = []
+        try:
+            sock.sendall(b'Asterisk Call Manager/5.0.1\r\n')
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                while b'\r\n\r\n' in buffer:
+                    block, buffer = buffer.split(b'\r\n\r\n', 1)
+                    action = parse_message(block.decode())
+                    if action.get('Action') == 'Login':
+                        sock.sendall(self.message(('Response', 'Success'), ('ActionID', action['ActionID']), ('Message', 'Authentication accepted')))
+                    elif action.get('Action') == 'Originate':
+                        queued.append(action)
+                if len(queued) >= self.batch:
+                    sock.sendall(b''.join(self.answer(action) for action in reversed(queued)))
+                    self.originates += len(queued)
+                    queued = []
+        except OSError:
+            return
+
+    def answer(self, action):
+        number = action['Channel'].split('/', 1)[1].split('@', 1)[0]
+        result = 'Failure' if number in self.failing else 'Success'
+        return self.message(
+            ('Response', 'Success'), ('ActionID', action['ActionID']), ('Message', 'Originate successfully queued')
+        ) + self.message(
+            ('Event', 'Newchannel'), ('Privilege', 'call,all'), ('Channel', 'Local/' + number)
+        ) + self.message(
+            ('Event', 'OriginateResponse'), ('Privilege', 'call,all'), ('ActionID', action['ActionID']),
+            ('Response', result), ('Channel', action['Channel']), ('Reason', 4 if result == 'Success' else 5)
+        )
+
+    @staticmethod
+    def message(*fields):
+        return (''.join(f"{key}: {value}\r\n" for key, value in fields) + '\r\n').encode()
+
+def bench_ami(calls, batches, fail_every):
+    # AmiOriginator against FakeAmiServer: pipelined batches, OriginateResponse matching and a reconnect
+    logger = logging.getLogger('autodial_benchmark')
+    # Every failing number logs a warning, only errors are worth printing here
+    logger.setLevel(logging.ERROR)
+    numbers = random_numbers(calls)
+    failing = numbers[::fail_every] if fail_every else []
+    server = FakeAmiServer(calls, failing)
+    results = {}
+    client = AmiClient(logger, port=server.port, username='bench', secret='bench', response_timeout=5, backoff=0.1)
+    originator = AmiOriginator(client, logger, on_result=lambda callid, message: results.__setitem__(callid, message['Response']))
+    call_process = CallProcess(None, None, None, originator=originator)
+    callid = itertools.count(1)
+
+    def batch():
+        return [('0800000000', number, next(callid), 'support', 'bench', None) for number in numbers]
+
+    def wait_for_results(expected):
+        deadline = time.monotonic() + 5
+        while len(results) < expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    try:
+        seconds = []
+        for _ in range(batches):
+            started = time.perf_counter()
+            accepted = len(call_process.make_call_files(batch()))
+            seconds.append(time.perf_counter() - started)
+            if accepted != calls:
+                raise AssertionError(f"{accepted} of {calls} Originate actions accepted")
+        wait_for_results(calls * batches)
+
+        # The drop happens between ticks: wait until the reader has seen it, then the next batch reconnects
+        server.drop()
+        deadline = time.monotonic() + 5
+        while client.sock is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        reconnected = len(call_process.make_call_files(batch()))
+        wait_for_results(calls * (batches + 1))
+    finally:
+        originator.close()
+        server.close()
+
+    expected_failures = len(failing) * (batches + 1)
+    failures = sum(1 for response in results.values() if response != 'Success')
+    if reconnected != calls or client.connects != 2:
+        raise AssertionError(f"Reconnect failed: {reconnected} accepted, {client.connects} connects")
+    if len(results) != calls * (batches + 1) or failures != expected_failures or originator.calls:
+        raise AssertionError(f"{len(results)} OriginateResponse matched, {failures} failures, {len(originator.calls)} left unmatched")
+
+    return {
+        'benchmark': 'ami',
+        'calls_per_batch': calls,
+        'batches': batches,
+        'originates': server.originates,
+        'matched': len(results),
+        'failed': failures,
+        'connects': client.connects,
+        'batch_p50_s': percentile(seconds, 0.5),
+        'originates_per_s': calls * batches / sum(seconds),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Autodialer benchmarks, results are printed as JSON")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    prefixes_parser = subparsers.add_parser('prefixes', help="operator prefix classification")
+    prefixes_parser.add_argument('--count', type=int, default=50000)
+    prefixes_parser.add_argument('--repeat', type=int, default=5)
+
+    ami_parser = subparsers.add_parser('ami', help="AMI Originate backend against a local fake manager")
+    ami_parser.add_argument('--calls', type=int, default=200, help="Originate actions per pipelined batch")
+    ami_parser.add_argument('--batches', type=int, default=5)
+    ami_parser.add_argument('--fail-every', type=int, default=10, help="every Nth number gets a Failure OriginateResponse")
+
+    workload_parser = subparsers.add_parser('workload', help="process_marks against a seeded MySQL database")
+    workload_parser.add_argument('--host', default='127.0.0.1')
+    workload_parser.add_argument('--port', type=int, default=3306)
+    workload_parser.add_argument('--user', default='root')
+    workload_parser.add_argument('--password', default='')
+    # Tables in this database are dropped and recreated when --seed is given
+    workload_parser.add_argument('--database', required=True)
+    workload_parser.add_argument('--seed', type=int, default=0, help="processed history rows to create, 0 reuses the existing data")
+    workload_parser.add_argument('--backlog', type=int, default=10000, help="NEW rows that are already due")
+    workload_parser.add_argument('--redials', type=int, default=1000)
+    workload_parser.add_argument('--sleeptime', type=int, default=1)
+    workload_parser.add_argument('--rate', type=float, default=20, help="live marks per second during the run")
+    workload_parser.add_argument('--duration', type=float, default=30)
+    workload_parser.add_argument('--capacity', choices=sorted(capacity_profiles), default='office')
+    workload_parser.add_argument('--batch', action='store_true', help="batch_dispatch mode")
+    workload_parser.add_argument('--concurrent', action='store_true', help="concurrent_handlers mode")
+    workload_parser.add_argument('--incremental', action='store_true', help="incremental_marks reader")
+    workload_parser.add_argument('--fsync', action='store_true', help="fsync call files like production does")
+    workload_parser.add_argument('--keep', action='store_true', help="keep the temporary spool and config")
+
+    args = parser.parse_args()
+    if args.benchmark == 'prefixes':
+        result = bench_operator_prefixes(args.count, args.repeat)
+    elif args.benchmark == 'ami':
+        result = bench_ami(args.calls, args.batches, args.fail_every)
+    elif args.benchmark == 'workload':
+        result = bench_workload(args)
+
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+if __name__ == "__main__":
+    main()
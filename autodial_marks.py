@@ -8,8 +8,11 @@ import argparse
 import requests
 import configparser
 import random
+import pwd
+import grp
 from helpers.create_logger import create_logger
 from helpers.calc_free import calc_free_sim
+from db_connection import ConnectionManager
 from datetime import datetime, timedelta
 
 logger = create_logger(f"autodial_marks")
@@ -18,7 +21,8 @@ print_log = True
 no_sim_sleeptime = 5
 mv_sim_sleeptime = 20
 no_dialers_sleeptime = 300
-step_sleep_time=5
+default_step_sleep_time = 5
+step_sleep_time = default_step_sleep_time
 
 redials_missed_calls = 1
 redials_timeout = 300
@@ -31,14 +35,18 @@ config.read('/opt/pydialer/config.ini')
 operator_list = ['mts', 'ks', 'life']
 call_file_dir = '/var/www/html/asterisk/call'
 asterisk_outgoing = '/var/spool/asterisk/outgoing'
+asterisk_owner = None
 
 def calcFree(numbers, cur, mark_type, ivr_branch, dep_id, department_callerid):
+    global step_sleep_time
     free = calc_free_sim(cur, dep_id, print_log, logger)
     if free['mts'] == 0 and free['ks'] == 0 and free['life'] == 0 and free['all'] == 0 and free['trunk_enable'] == 0:
         step_sleep_time = no_sim_sleeptime
         print("no free sim")
         return
 
+    step_sleep_time = default_step_sleep_time
+
     print(free)
     logger.info(f"free are {free}")
 
@@ -47,12 +55,15 @@ def calcFree(numbers, cur, mark_type, ivr_branch, dep_id, department_callerid):
     local_operator_list = list(operator_list) + ['all',]
     if free['trunk_enable'] == 1: local_operator_list.append('all_trunk')    
 
+    dispatched = set()
     for oper in local_operator_list:
 
         if oper == 'all' or oper == 'all_trunk':
-            selected_numbers = numbers[:free[oper]]
+            # Numbers already placed on their operator's SIMs must not be dialed a second time from the shared slots
+            selected_numbers = [num for num in numbers if num['id'] not in dispatched][:max(free[oper], 0)]
         else:
-            selected_numbers = [num for num in numbers if num['oper'] == oper][:free[oper]]
+            selected_numbers = [num for num in numbers if num['oper'] == oper][:max(free[oper], 0)]
+        dispatched.update(num['id'] for num in selected_numbers)
            
         print(f"selected_numbers {selected_numbers}")
         logger.info(f"selected_numbers {selected_numbers}")
@@ -75,18 +86,9 @@ def calcFree(numbers, cur, mark_type, ivr_branch, dep_id, department_callerid):
                 makeFile(department_callerid, number['client_number'], number['id'], ivr_branch)    
                      
 def getLastCallNumbers(start_time, end_time, cur):
-    query = f"SELECT DISTINCT client_number FROM autodial_marks WHERE mark_type = 'last_call' AND callback_status = 'NEW' AND calldate BETWEEN '{start_time}' AND '{end_time}';"
-    cur.execute(query)
-    numbers = cur.fetchall()
-
-    detail_information = []
-    for number in numbers:
-        cur.execute("SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `recordingfile` FROM `autodial_marks` WHERE `client_number` = %s AND callback_status = 'NEW' ORDER BY `autodial_marks`.`id` DESC LIMIT 1",(number['client_number'],))
-        result = cur.fetchone()
-        if result:
-            detail_information.append(result)
-    
-    return detail_information
+    # One query instead of one per client, see idx_marks_new_window in autodial_marks_oop.py
+    cur.execute("SELECT am.`id`, am.`calldate`, am.`client_number`, am.`operator_number`, am.`billsec`, am.`queue`, am.`recordingfile` FROM `autodial_marks` am JOIN (SELECT MAX(`id`) AS id FROM `autodial_marks` WHERE `mark_type` = 'last_call' AND `callback_status` = 'NEW' AND `calldate` BETWEEN %s AND %s GROUP BY `client_number`) latest ON latest.id = am.id ORDER BY am.`id`", (start_time, end_time))
+    return list(cur.fetchall())
 
 def assign_operators_to_numbers(detail_information):
     if isinstance(detail_information, dict):
@@ -100,9 +102,9 @@ def assign_operators_to_numbers(detail_information):
         if client_number.startswith(('+38066', '+38095', '+38050')):  # VF
             oper = 'mts'
         elif client_number.startswith(('+38067', '+38068', '+38096', '+38097', '+38098')):  # KS
-            oper = 'kyivstar'
+            oper = 'ks'
         elif client_number.startswith(('+38063', '+38073', '+38093')):  # Life
-            oper = 'lifecell'
+            oper = 'life'
         else:
             oper = 'unknown'
         
@@ -113,6 +115,10 @@ def assign_operators_to_numbers(detail_information):
     return updated_information
 
 def makeFile(dep_cid, number, callid, queue_ivr_branch):
+    global asterisk_owner
+    if asterisk_owner is None:
+        asterisk_owner = (pwd.getpwnam('asterisk').pw_uid, grp.getgrnam('asterisk').gr_gid)
+
     body = f'''Channel: Local/{number}@from-autodial-marks
 MaxRetries: 0
 RetryTime: 60
@@ -127,26 +133,26 @@ Setvar: queue_branch={queue_ivr_branch}
     # Create call file
     file_name = f"callback_ocinka-{number}.call"
     call_file = os.path.join(call_file_dir, file_name)
-    f = open(call_file, "w")
-    f.write(body)
-    f.close()
+    with open(call_file, "w") as f:
+        f.write(body)
+        os.fchown(f.fileno(), *asterisk_owner)
     logger.info(f"Created file {file_name}")
     print(f"Created file {file_name}")
-    os.popen(f"chown asterisk:asterisk {call_file}")
-    time.sleep(0.1)
     os.rename(f"{call_file}", f"{asterisk_outgoing}/{file_name}")
     
 
+# One connection for the whole run, pinged and revived between ticks instead of a new handshake every tick
+db = ConnectionManager.from_config(config, logger)
+
 while True:
     time.sleep(step_sleep_time)
-    con = pymysql.connect(host=config['mysql']['host'],
-                          user=config['mysql']['user'],
-                          password=config['mysql']['password'],
-                          database=config['mysql']['database'],
-                          charset='utf8',
-                          cursorclass=pymysql.cursors.DictCursor)
-    with con:
-        cur = con.cursor()
+    try:
+        con = db.connection()
+    except pymysql.err.MySQLError as e:
+        print(f"MySQL is unavailable, skipping tick: {e}")
+        logger.error(f"MySQL is unavailable, skipping tick: {e}")
+        continue
+    with con.cursor() as cur:
         cur.execute("SELECT MAX(CASE WHEN `calls_type` = 'last_call' THEN `enable` END) AS `enable_last_call`, MAX(CASE WHEN `calls_type` = 'incoming' THEN `enable` END) AS `enable_incoming`, MAX(CASE WHEN `calls_type` = 'manual_out' THEN `enable` END) AS `enable_manual_out` FROM `operator_marks_setting` WHERE `calls_type` IN ('last_call', 'incoming', 'manual_out')")
         markSettings = cur.fetchone()
         
@@ -239,7 +245,7 @@ while True:
 
                 print(f"Sleeptime: {sleeptime}, Department Caller ID: {department_callerid}, steps: {steps} ")
 
-                cur.execute("SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `recordingfile` FROM `autodial_marks` WHERE `mark_type` = %s AND callback_status = 'NEW' AND NOW() > `calldate` + INTERVAL %s SECOND LIMIT 1",(mark_type, sleeptime))
+                cur.execute("SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `recordingfile` FROM `autodial_marks` WHERE `mark_type` = %s AND callback_status = 'NEW' AND `calldate` < NOW() - INTERVAL %s SECOND LIMIT 1",(mark_type, sleeptime))
                 detail_information = cur.fetchone()
 
                 print(f"Detail Information: {detail_information}")
@@ -278,7 +284,7 @@ while True:
 
                 print(f"Sleeptime: {sleeptime}, Department Caller ID: {department_callerid}, steps: {steps} ")
 
-                cur.execute("SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `recordingfile` FROM `autodial_marks` WHERE `mark_type` = %s AND callback_status = 'NEW' AND NOW() > `calldate` + INTERVAL %s SECOND LIMIT 1",(mark_type, sleeptime))
+                cur.execute("SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `recordingfile` FROM `autodial_marks` WHERE `mark_type` = %s AND callback_status = 'NEW' AND `calldate` < NOW() - INTERVAL %s SECOND LIMIT 1",(mark_type, sleeptime))
                 detail_information = cur.fetchone()
 
                 print(f"Detail Information: {detail_information}")
@@ -308,7 +314,7 @@ while True:
 
         if redials_missed_calls:
             print("Redials missed calls")
-            cur.execute("SELECT `client_number`, `operator_number`, `date_callback`, `queue`, `evaluated_call_id`, `mark_type` FROM `operator_marks` WHERE `call_attempts` = 1 AND `callback_status` != 'INITED' AND `callback_status` != 'ANSWERED' AND NOW() > `date_callback` + INTERVAL %s SECOND LIMIT 1", (redials_timeout))
+            cur.execute("SELECT `client_number`, `operator_number`, `date_callback`, `queue`, `evaluated_call_id`, `mark_type` FROM `operator_marks` WHERE `call_attempts` = 1 AND `callback_status` != 'INITED' AND `callback_status` != 'ANSWERED' AND `date_callback` < NOW() - INTERVAL %s SECOND LIMIT 1", (redials_timeout))
             call = cur.fetchone()
 
             print(f"Detail Information: {call}")
@@ -347,4 +353,5 @@ while True:
             print("Redials missed calls is disable")
             logger.info("Redials missed calls is disable") 
 
-
+        # Ends the read transaction, otherwise the next tick would keep seeing the same snapshot
+        con.commit()
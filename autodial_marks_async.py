@@ -0,0 +1,614 @@
+import signal
+import asyncio
+import inspect
+import configparser
+from contextlib import asynccontextmanager
+from helpers.create_logger import create_logger as file_handler
+from helpers.calc_free import calc_free_sim
+from dialer_metrics import Metrics
+from db_connection import ConnectionManager, ConnectionPool
+from ami_dispatch import AmiOriginator
+from autodial_marks_oop import (
+    AdaptiveScheduler, CallHandler, CallProcess, CapacityTracker, ConfigCache, DispatchLocks, LastCallHandler, Logger,
+    OperatorAudioCache, OperatorPrefixes, PendingMarks, Redial, SpoolMonitor, mark_status_filter,
+    CALL_UNIQUEID_SQL, INSERT_OPERATOR_MARKS_SQL, LAST_CALL_NUMBERS_SQL, NEW_MARK_IDS_SQL, NEW_MARKS_AFTER_SQL, NUMBERS_FOR_CALL_SQL,
+    OPERATOR_AUDIO_CHECKSUM_SQL, OPERATOR_AUDIO_SQL, REDIAL_INITED_SQL, REDIAL_NUMBERS_SQL, REDIAL_RESTORE_SQL,
+)
+
+# asyncio engine: the same flows as autodial_marks_oop, but every mark type and department waits on
+# MySQL concurrently in one thread. Needs aiomysql or asyncmy; the blocking pieces that are left
+# (helpers.calc_free_sim and the spool writes) run in worker threads.
+try:
+    import aiomysql as mysql_driver
+    from aiomysql import DictCursor
+    database_arg = 'db'
+except ImportError:
+    try:
+        import asyncmy as mysql_driver
+        from asyncmy.cursors import DictCursor
+        database_arg = 'database'
+    except ImportError:
+        mysql_driver = None
+        DictCursor = None
+        database_arg = None
+
+async def fetch_all(cur):
+    # aiomysql returns awaitables from fetch*, asyncmy plain values
+    rows = cur.fetchall()
+    if inspect.isawaitable(rows):
+        rows = await rows
+    return list(rows)
+
+async def fetch_one(cur):
+    row = cur.fetchone()
+    if inspect.isawaitable(row):
+        row = await row
+    return row
+
+class AsyncConfigCache(ConfigCache):
+    # Expired tables are reloaded by refresh() once per pass, the sync accessors then only read memory
+    def __init__(self, logger, ttls=None):
+        super().__init__(logger, ttls)
+        self.refresh_lock = asyncio.Lock()
+
+    async def refresh(self, cur):
+        async with self.refresh_lock:
+            for table, (query, build) in self.loaders.items():
+                if self.expired(table):
+                    await cur.execute(query)
+                    self.store(table, build(await fetch_all(cur)))
+
+    def get(self, cur, table):
+        self.hits[table] += 1
+        return self.tables[table]
+
+class AsyncOperatorAudioCache(OperatorAudioCache):
+    def __init__(self, logger, check_interval=60):
+        super().__init__(logger, check_interval)
+        self.refresh_lock = asyncio.Lock()
+
+    async def refresh(self, cur, force=False):
+        async with self.refresh_lock:
+            if not self.due(force):
+                return
+            await cur.execute(OPERATOR_AUDIO_CHECKSUM_SQL)
+            signature = self.signature_of(await fetch_one(cur))
+            if signature == self.signature and not force:
+                return
+            await cur.execute(OPERATOR_AUDIO_SQL)
+            self.load(await fetch_all(cur), signature)
+
+    def get(self, cur, operator_number):
+        return self.lookup(operator_number)
+
+class AsyncDispatchLocks:
+    # DispatchLocks for coroutines: per department, most urgent mark type first, reentrant per task
+    def __init__(self):
+        self.condition = asyncio.Condition()
+        self.owners = {}
+        self.waiting = {}
+        self.tickets = 0
+
+    @asynccontextmanager
+    async def hold(self, dep_id, call_type):
+        task = asyncio.current_task()
+        async with self.condition:
+            owner = self.owners.get(dep_id)
+            if owner and owner[0] is task:
+                self.owners[dep_id] = (task, owner[1] + 1)
+            else:
+                self.tickets += 1
+                ticket = (DispatchLocks.priorities.get(call_type, len(DispatchLocks.priorities)), self.tickets)
+                waiters = self.waiting.setdefault(dep_id, [])
+                waiters.append(ticket)
+                try:
+                    await self.condition.wait_for(lambda: dep_id not in self.owners and min(waiters) == ticket)
+                finally:
+                    waiters.remove(ticket)
+                self.owners[dep_id] = (task, 1)
+        try:
+            yield
+        finally:
+            async with self.condition:
+                task, depth = self.owners[dep_id]
+                if depth > 1:
+                    self.owners[dep_id] = (task, depth - 1)
+                else:
+                    del self.owners[dep_id]
+                    self.condition.notify_all()
+
+class AsyncScheduler(AdaptiveScheduler):
+    # Same back-off as AdaptiveScheduler; the wait is a cancellable timer and the wake FIFO a loop reader
+    def attach(self, loop):
+        self.wake = asyncio.Event()
+        if self.fifo_fd is not None:
+            loop.add_reader(self.fifo_fd, self.on_fifo)
+
+    def on_fifo(self):
+        self.drain_fifo()
+        self.wake.set()
+
+    async def wait(self, probe=None):
+        try:
+            await asyncio.wait_for(self.wake.wait(), self.interval)
+            self.logger.debug("Woken up by external signal")
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.wake.clear()
+
+class AsyncCallProcess(CallProcess):
+    def __init__(self, logger, config_cache, operator_audio, operator_prefixes=None, metrics=None, sync_pool=None, capacity=None,
+                 spool_monitor=None, originator=None):
+        super().__init__(logger, config_cache, operator_audio, operator_prefixes, metrics, capacity, spool_monitor, originator)
+        self.dispatch_locks = AsyncDispatchLocks()
+        self.sync_pool = sync_pool
+
+    def calc_free_blocking(self, dep_id):
+        # helpers.calc_free_sim only speaks pymysql, so it gets a blocking connection in a worker thread
+        with self.sync_pool.connection() as con, con.cursor() as cur:
+            return calc_free_sim(cur, dep_id, True, self.logger)
+
+    async def get_free_sim(self, cur, dep_id):
+        free = self.capacity.cached(dep_id)
+        if free is None:
+            with self.metrics.timer('autodial_calc_free_sim_seconds'):
+                free = self.capacity.refresh(dep_id, await asyncio.to_thread(self.calc_free_blocking, dep_id))
+        self.record_free_sim(dep_id, free)
+        return free
+
+    async def admit(self, callerid, numbers):
+        # The spool scan reads files, so it runs in a worker thread before admit() finds it fresh
+        if self.spool_monitor.due():
+            await asyncio.to_thread(self.spool_monitor.scan)
+        return self.spool_monitor.admit(callerid, numbers)
+
+    async def calc_free_and_process(self, numbers, cur, call_type, ivr_branch, dep_id, department_callerid, start_time, end_time, free=None):
+        async with self.dispatch_locks.hold(dep_id, call_type):
+            if free is None:
+                free = await self.get_free_sim(cur, dep_id)
+            self.logger.info("Free sim in dep %s: %s, numbers: %s", department_callerid, free, self.logger.summary(numbers, 'client_number'))
+            if not any(value > 0 for value in free.values()):
+                self.logger.warning(f"No free sim in dep {department_callerid}, for call type: {call_type}")
+                return 0
+
+            numbers, headroom = await self.admit(department_callerid, numbers)
+            plan = self.plan_dispatch(numbers, free)[:headroom]
+            dispatched = await self.process_calls(cur, [number for _, number in plan], call_type, ivr_branch, department_callerid, start_time, end_time)
+            if dispatched:
+                self.capacity.reserve(dep_id, self.spooled_slots(plan, dispatched))
+            return len(dispatched)
+
+    async def process_calls(self, cur, numbers, call_type, ivr_branch, department_callerid, start_time, end_time):
+        calls = []
+        for number in numbers:
+            number_ivr_branch = number.get('ivr_branch', ivr_branch)
+            if number_ivr_branch:
+                audio_filename = self.get_operator_audio_by_number(cur, number['operator_number'], call_type)
+                calls.append((number, number_ivr_branch, audio_filename))
+            else:
+                self.logger.error(f"IVR branch is null for call type: {call_type}")
+
+        if not calls:
+            return []
+
+        if not await self.save_calls(cur, [number for number, _, _ in calls], call_type, start_time, end_time):
+            self.logger.error(f"Failed to add calls to operator marks for call type: {call_type}, numbers: {[number['client_number'] for number, _, _ in calls]}")
+            return []
+
+        sent = set(await self.make_call_files([
+            (department_callerid, number['client_number'], number['id'], number_ivr_branch, number['uniqueid'], audio_filename)
+            for number, number_ivr_branch, audio_filename in calls
+        ]))
+        dispatched = [number for number, _, _ in calls if number['id'] in sent]
+        if len(dispatched) < len(calls):
+            await self.restore_calls(cur, [number for number, _, _ in calls if number['id'] not in sent], call_type)
+        for number in dispatched:
+            self.metrics.inc('autodial_callbacks_dispatched_total', mark_type=call_type, operator=number['oper'])
+        return dispatched
+
+    async def save_calls(self, cur, numbers, call_type, start_time=None, end_time=None):
+        try:
+            await cur.connection.begin()
+            await cur.executemany(INSERT_OPERATOR_MARKS_SQL, self.operator_marks_rows(numbers, call_type))
+            await cur.execute(*self.calls_status_update(numbers, call_type, start_time, end_time))
+            with self.metrics.timer('autodial_db_commit_seconds'):
+                await cur.connection.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error while saving calls for rating '{call_type}', changes rolled back: {e}")
+            await cur.connection.rollback()
+            return False
+
+    async def restore_calls(self, cur, numbers, call_type):
+        try:
+            await cur.connection.begin()
+            for statement in self.restore_statements(numbers, call_type):
+                await cur.execute(*statement)
+            await cur.connection.commit()
+            self.logger.warning(f"Calls not accepted by Asterisk for call type: {call_type}, marks back to NEW: {[number['client_number'] for number in numbers]}")
+        except Exception as e:
+            self.logger.error(f"Error while restoring marks for rating '{call_type}': {e}")
+            await cur.connection.rollback()
+
+    async def make_call_files(self, calls):
+        if self.originator:
+            return await asyncio.to_thread(self.originator.originate_batch, [(call[2], self.call_fields(*call)) for call in calls])
+        files = [self.build_call_file(*call) for call in calls]
+        return self.published_callids(calls, files, await asyncio.to_thread(self.spool.write_batch, files))
+
+class AsyncLastCallHandler(LastCallHandler):
+    async def handle_last_call(self, cur, call_type):
+        self.logger.debug("Mark %s is start", call_type)
+        settings = self.get_call_settings(cur, call_type)
+        if not settings:
+            self.logger.error(f"Failed to get call settings for call type: {call_type}")
+            return 0
+        start_time, end_time = self.get_time_range(settings)
+        if not (start_time and end_time):
+            return 0
+
+        detail_information = await self.get_last_call_numbers(cur, start_time, end_time, call_type)
+        if not detail_information:
+            self.logger.debug("Detail information for call type %s si null", call_type)
+            return 0
+        self.logger.info("Detail information for call type %s: %s", call_type,
+                         self.logger.summary(detail_information, 'client_number'), call_type=call_type, rows=len(detail_information))
+        ivr_branch = self.get_ivr_branch(cur, call_type)
+        if not ivr_branch:
+            self.logger.error(f"Failed to get IVR branch for call type: {call_type}")
+            return 0
+        updated_information = self.call_process.assign_operators_to_numbers(detail_information)
+        return await self.call_process.calc_free_and_process(
+            updated_information, cur, call_type, ivr_branch,
+            settings['dep_id'], settings['callerid'], start_time, end_time)
+
+    async def get_last_call_numbers(self, cur, start_time, end_time, call_type):
+        try:
+            status_clause, status_params = mark_status_filter(None)
+            await cur.execute(LAST_CALL_NUMBERS_SQL.format(status_clause=status_clause), (call_type, *status_params, start_time, end_time))
+            return await fetch_all(cur)
+        except Exception as e:
+            self.logger.error(f"Error while getting numbers for {call_type}: {e}")
+            return []
+
+class AsyncCallHandler(CallHandler):
+    async def handle_call(self, cur, call_type):
+        self.logger.debug("Mark %s is started", call_type)
+        settings = self.get_call_settings(cur, call_type)
+        if not settings:
+            self.logger.error(f"Failed to get call settings for call type: {call_type}")
+            return 0
+        if not self.batch_mode:
+            return await self.dispatch_numbers(cur, call_type, settings, 1, None)
+
+        async with self.call_process.dispatch_locks.hold(settings['dep_id'], call_type):
+            free = await self.call_process.get_free_sim(cur, settings['dep_id'])
+            limit = self.call_process.free_capacity(free)
+            if not limit:
+                self.logger.warning(f"No free sim in dep {settings['callerid']}, for call type: {call_type}")
+                return 0
+            return await self.dispatch_numbers(cur, call_type, settings, limit, free)
+
+    async def dispatch_numbers(self, cur, call_type, settings, limit, free):
+        detail_information = await self.get_numbers_for_call(cur, call_type, settings['sleeptime'], limit)
+        if not detail_information:
+            self.logger.debug("Detail information for call type %s si null", call_type)
+            return 0
+        self.logger.info("Detail information for call type %s: %s", call_type,
+                         self.logger.summary(detail_information, 'client_number'), call_type=call_type, rows=len(detail_information))
+        numbers = []
+        for detail in detail_information:
+            detail['ivr_branch'] = self.get_ivr_branch(cur, call_type, detail)
+            if detail['ivr_branch']:
+                numbers.append(detail)
+            else:
+                self.logger.error(f"Failed to get IVR branch for call type: {call_type}, number: {detail['client_number']}")
+        if not numbers:
+            return 0
+        updated_information = self.call_process.assign_operators_to_numbers(numbers)
+        return await self.call_process.calc_free_and_process(updated_information, cur, call_type, None, settings['dep_id'], settings['callerid'], None, None, free)
+
+    async def get_numbers_for_call(self, cur, call_type, sleeptime, limit=1):
+        try:
+            if call_type in self.pending:
+                return await self.pending_numbers(cur, self.pending[call_type], sleeptime, limit)
+            status_clause, status_params = mark_status_filter(None)
+            await cur.execute(NUMBERS_FOR_CALL_SQL.format(status_clause=status_clause), (call_type, *status_params, sleeptime, limit))
+            return await fetch_all(cur)
+        except Exception as e:
+            self.logger.error(f"Error while getting the number for rating {call_type}: {e}")
+            return []
+
+    async def pending_numbers(self, cur, pending, sleeptime, limit):
+        # PendingMarks.numbers with awaited queries
+        params = pending.fetch_params()
+        while params:
+            await cur.execute(NEW_MARKS_AFTER_SQL, params)
+            params = pending.add(await fetch_all(cur)) and pending.fetch_params()
+
+        numbers = []
+        while len(numbers) < limit:
+            taken = {number['id'] for number in numbers}
+            chosen = [number for number in pending.due(sleeptime, limit) if number['id'] not in taken]
+            if not chosen:
+                break
+            await cur.execute(NEW_MARK_IDS_SQL.format(placeholders=', '.join(['%s'] * len(chosen))), [number['id'] for number in chosen])
+            valid, stale = pending.validate(chosen, {row['id'] for row in await fetch_all(cur)})
+            numbers.extend(valid)
+            if not stale:
+                break
+        return numbers
+
+class AsyncRedial(Redial):
+    pool = None  # set by AsyncAutodialer once the pool is open
+
+    async def redial_handle_call(self, cur):
+        self.logger.debug("Mark redial is started")
+        limit = self.batch_size if self.batch_mode else 1
+        detail_information = await self.get_redial_numbers(cur, limit)
+        if not detail_information:
+            self.logger.debug("Detail information for Recal si null")
+            return 0
+        self.logger.info("Detail information for redial: %s", self.logger.summary(detail_information, 'client_number'),
+                         call_type='redial', rows=len(detail_information))
+
+        departments = {}
+        for detail in detail_information:
+            department_settings = self.get_department_settings(cur, detail['mark_type'])
+            ivr_branch = self.get_ivr_branch(cur, detail)
+            if not ivr_branch:
+                self.logger.error(f"Failed to get IVR branch for Redial where call type: {detail['mark_type']}")
+                continue
+            uniqueid = await self.get_call_uniqueid(cur, detail['evaluated_call_id'])
+            if department_settings is None or uniqueid is None:
+                self.logger.error("Failed to create redials file. One or more parameters are empty")
+                continue
+            detail['ivr_branch'] = ivr_branch
+            detail['uniqueid'] = uniqueid['uniqueid']
+            detail['audio_filename'] = self.call_process.get_operator_audio_by_number(cur, detail['operator_number'], detail['mark_type'])
+            departments.setdefault(department_settings['dep_id'], (department_settings, []))[1].append(detail)
+
+        # Departments do not share SIMs, so their redials go out concurrently
+        results = await asyncio.gather(*(
+            self.make_redial_call(self.call_process.assign_operators_to_numbers(numbers), department_settings)
+            for department_settings, numbers in departments.values()
+        ))
+        return sum(results)
+
+    async def get_redial_numbers(self, cur, limit=1):
+        try:
+            await cur.execute(REDIAL_NUMBERS_SQL, (self.redials_timeout, limit))
+            return await fetch_all(cur)
+        except Exception as e:
+            self.logger.error(f"Error while getting the number for callback: {e}")
+            return []
+
+    async def get_call_uniqueid(self, cur, evaluated_call_id):
+        try:
+            await cur.execute(CALL_UNIQUEID_SQL, (evaluated_call_id,))
+            return await fetch_one(cur)
+        except Exception as e:
+            self.logger.error(f"Error while getting the unique call identifier during callback ID '{evaluated_call_id}': {e}")
+            return None
+
+    async def make_redial_call(self, numbers, department_settings):
+        # A connection runs one statement at a time, so each department gets its own from the pool
+        async with self.pool.acquire() as con, con.cursor(DictCursor) as cur:
+            async with self.call_process.dispatch_locks.hold(department_settings['dep_id'], 'redial'):
+                free = await self.call_process.get_free_sim(cur, department_settings['dep_id'])
+                plan = []
+                if any(value > 0 for value in free.values()):
+                    numbers, headroom = await self.call_process.admit(department_settings['callerid'], numbers)
+                    plan = self.call_process.plan_dispatch(numbers, free)[:headroom]
+                batch = [number for _, number in plan]
+                if not batch or not await self.update_calls(cur, [number['evaluated_call_id'] for number in batch]):
+                    return 0
+
+                sent = set(await self.call_process.make_call_files([
+                    (department_settings['callerid'], number['client_number'], number['evaluated_call_id'],
+                     number['ivr_branch'], number['uniqueid'], number['audio_filename'])
+                    for number in batch
+                ]))
+                if len(sent) < len(batch):
+                    await self.restore_calls(cur, [number for number in batch if number['evaluated_call_id'] not in sent])
+                self.call_process.capacity.reserve(department_settings['dep_id'], [oper for oper, number in plan if number['evaluated_call_id'] in sent])
+                for number in batch:
+                    if number['evaluated_call_id'] in sent:
+                        self.call_process.metrics.inc('autodial_redials_dispatched_total', mark_type=number['mark_type'], operator=number['oper'])
+                return len(sent)
+
+    async def update_calls(self, cur, evaluated_call_ids):
+        try:
+            await cur.connection.begin()
+            await cur.execute(REDIAL_INITED_SQL.format(placeholders=', '.join(['%s'] * len(evaluated_call_ids))), evaluated_call_ids)
+            await cur.connection.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error while updating the call status with IDs {evaluated_call_ids}: {e}")
+            await cur.connection.rollback()
+            return False
+
+    async def restore_calls(self, cur, numbers):
+        try:
+            await cur.connection.begin()
+            await cur.executemany(REDIAL_RESTORE_SQL, self.restore_rows(numbers))
+            await cur.connection.commit()
+            self.logger.warning(f"Redials not accepted by Asterisk, status restored: {[number['evaluated_call_id'] for number in numbers]}")
+        except Exception as e:
+            self.logger.error(f"Error while restoring the status of redials {[number['evaluated_call_id'] for number in numbers]}: {e}")
+            await cur.connection.rollback()
+
+class AsyncAutodialer:
+    def __init__(self, config_path='/opt/pydialer/config.ini'):
+        if mysql_driver is None:
+            raise RuntimeError("The asyncio engine needs aiomysql or asyncmy: pip install aiomysql")
+
+        self.config = configparser.ConfigParser()
+        self.config.read(config_path)
+        if self.config.getboolean('autodial_marks', 'claim_rows', fallback=False):
+            # Claims are only implemented for the blocking engine, running without them could dial clients twice
+            raise RuntimeError("claim_rows is not supported by the asyncio engine, use autodial_marks_oop.py")
+
+        self.redial = True
+        self.redials_timeout = 600
+        self.debug_status = True
+        self.batch_dispatch = self.config.getboolean('autodial_marks', 'batch_dispatch', fallback=False)
+        self.redial_batch_size = self.config.getint('autodial_marks', 'redial_batch_size', fallback=50)
+        self.handler_wait = self.config.getfloat('autodial_marks', 'handler_wait', fallback=1)
+        self.running = {}
+        self.pool = None
+
+        self.logger = Logger(
+            file_handler("autodial_marks"), self.debug_status,
+            console=self.config.getboolean('logging', 'console', fallback=True),
+            json_lines=self.config.getboolean('logging', 'json', fallback=False),
+            max_list_items=self.config.getint('logging', 'max_list_items', fallback=10)
+        )
+        self.metrics = Metrics.from_config(self.config, self.logger)
+        self.sync_pool = ConnectionPool(lambda: ConnectionManager.from_config(self.config, self.logger, autocommit=True), size=2)
+
+        self.config_cache = AsyncConfigCache(self.logger, {
+            table: self.config.getfloat('config_cache_ttl', table, fallback=ttl)
+            for table, ttl in ConfigCache.default_ttls.items()
+        })
+        self.metrics.register(self.config_cache.collect_metrics)
+        self.operator_audio = AsyncOperatorAudioCache(
+            self.logger, self.config.getfloat('autodial_marks', 'operator_audio_check_interval', fallback=60))
+        self.capacity = CapacityTracker(
+            self.logger,
+            ttl=self.config.getfloat('autodial_marks', 'capacity_ttl', fallback=2),
+            settle=self.config.getfloat('autodial_marks', 'capacity_settle', fallback=5)
+        )
+        self.metrics.register(self.capacity.collect_metrics)
+        operator_prefixes = OperatorPrefixes.from_config(self.config)
+        self.spool_monitor = SpoolMonitor(
+            self.logger, '/var/spool/asterisk/outgoing', operator_prefixes, self.metrics,
+            scan_interval=self.config.getfloat('autodial_marks', 'spool_scan_interval', fallback=1),
+            max_pending=self.config.getint('autodial_marks', 'spool_max_pending', fallback=0),
+            max_depth=self.config.getint('autodial_marks', 'spool_max_depth', fallback=0)
+        )
+        self.metrics.register(self.spool_monitor.collect_metrics)
+        self.originator = None
+        if self.config.get('autodial_marks', 'dispatch_backend', fallback='callfile') == 'ami':
+            self.originator = AmiOriginator.from_config(self.config, self.logger, self.metrics)
+            self.metrics.register(self.originator.collect_metrics)
+        self.call_process = AsyncCallProcess(self.logger, self.config_cache, self.operator_audio, operator_prefixes,
+                                             self.metrics, self.sync_pool, self.capacity, self.spool_monitor, self.originator)
+        self.last_call_handler = AsyncLastCallHandler(self.call_process, self.logger, self.config_cache)
+        pending = None
+        if self.config.getboolean('autodial_marks', 'incremental_marks', fallback=False):
+            pending = {mark_type: PendingMarks.from_config(self.config, mark_type) for mark_type in ('incoming', 'manual_out')}
+        self.call_handler = AsyncCallHandler(self.call_process, self.logger, self.config_cache, self.batch_dispatch, pending=pending)
+        self.redial_call_handler = AsyncRedial(self.call_process, self.logger, self.config_cache, self.redials_timeout,
+                                               self.batch_dispatch, self.redial_batch_size)
+        self.scheduler = AsyncScheduler(
+            self.logger,
+            min_interval=self.config.getfloat('autodial_marks', 'min_interval', fallback=1),
+            max_interval=self.config.getfloat('autodial_marks', 'max_interval', fallback=30),
+            backoff_factor=self.config.getfloat('autodial_marks', 'backoff_factor', fallback=2),
+            wake_fifo=self.config.get('autodial_marks', 'wake_fifo', fallback=None)
+        )
+
+    async def open_pool(self):
+        self.pool = await mysql_driver.create_pool(
+            host=self.config['mysql']['host'],
+            port=self.config.getint('mysql', 'port', fallback=3306),
+            user=self.config['mysql']['user'],
+            password=self.config['mysql']['password'],
+            charset='utf8',
+            autocommit=True,
+            minsize=1,
+            maxsize=self.config.getint('mysql', 'async_pool_size', fallback=10),
+            **{database_arg: self.config['mysql']['database']}
+        )
+        self.redial_call_handler.pool = self.pool
+
+    @asynccontextmanager
+    async def cursor(self):
+        async with self.pool.acquire() as con, con.cursor(DictCursor) as cur:
+            yield cur
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self.config_cache.invalidate)
+        main_task = asyncio.current_task()
+        loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+        self.scheduler.attach(loop)
+        self.metrics.start()
+        await self.open_pool()
+        try:
+            while True:
+                await self.scheduler.wait()
+                dispatched = await self.process_marks()
+                self.scheduler.update(dispatched)
+                self.metrics.set('autodial_scheduler_interval_seconds', self.scheduler.interval)
+                self.metrics.export()
+        finally:
+            # Cancelled handlers roll back their open transactions when their connections are released
+            for task in self.running.values():
+                task.cancel()
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.sync_pool.close()
+            if self.originator:
+                self.originator.close()
+            self.logger.close()
+
+    async def process_marks(self):
+        try:
+            async with self.cursor() as cur:
+                with self.metrics.timer('autodial_tick_seconds'):
+                    await self.config_cache.refresh(cur)
+                    await self.operator_audio.refresh(cur)
+        except Exception as e:
+            self.logger.error(f"Error while loading mark settings: {e}")
+            return 0
+        mark_settings = self.config_cache.get_mark_settings(None)
+
+        # Most urgent first, as in the blocking engine
+        handlers = []
+        if mark_settings['enable_incoming']:
+            handlers.append(('incoming', self.call_handler.handle_call, ('incoming',)))
+        if mark_settings['enable_manual_out']:
+            handlers.append(('manual_out', self.call_handler.handle_call, ('manual_out',)))
+        if self.redial:
+            handlers.append(('redial', self.redial_call_handler.redial_handle_call, ()))
+        if mark_settings['enable_last_call']:
+            handlers.append(('last_call', self.last_call_handler.handle_last_call, ('last_call',)))
+        if mark_settings['enable_last_call_out']:
+            handlers.append(('last_call_out', self.last_call_handler.handle_last_call, ('last_call_out',)))
+
+        # Handlers still running from an earlier tick are left alone, the tick waits at most handler_wait seconds
+        for name, handle, args in handlers:
+            if name not in self.running:
+                self.running[name] = asyncio.create_task(self.run_handler(name, handle, args))
+        if self.running:
+            await asyncio.wait(list(self.running.values()), timeout=self.handler_wait)
+
+        dispatched = 0
+        for name, task in list(self.running.items()):
+            if task.done():
+                del self.running[name]
+                dispatched += task.result()
+        return dispatched
+
+    async def run_handler(self, name, handle, args):
+        try:
+            async with self.cursor() as cur:
+                with self.metrics.timer('autodial_handler_seconds', handler=name):
+                    return await handle(cur, *args)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Handler {name} failed: {e}")
+            return 0
+
+if __name__ == "__main__":
+    autodialer = AsyncAutodialer()
+    try:
+        asyncio.run(autodialer.run())
+    except asyncio.CancelledError:
+        pass
@@ -1,133 +1,919 @@
 import os
+import sys
+import json
 import time
+import queue
+import atexit
+import heapq
+import logging
+import itertools
+import threading
+import select
+import signal
 import pymysql
 import configparser
-import random
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+import socket
 import pwd
 import grp
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
 from helpers.create_logger import create_logger as file_handler
 from helpers.calc_free import calc_free_sim
+from dialer_metrics import Metrics, NullMetrics
+from db_connection import ConnectionManager, ConnectionPool
+from ami_dispatch import AmiOriginator
+
+# Statements shared by the blocking engine here and the asyncio one in autodial_marks_async
+MARK_SETTINGS_SQL = """
+    SELECT oms.*, d.id AS dep_id, d.callerid
+    FROM operator_marks_setting oms
+    LEFT JOIN departaments d ON d.name = oms.dep_name
+"""
+QUEUE_CALLBACKS_SQL = "SELECT queue_name, mark_ivr_menu FROM `config_queue_callbacks`"
+AGENT_MARKS_SQL = "SELECT sip, queue_ivr_branch FROM `config_agent_marks`"
+OPERATOR_AUDIO_CHECKSUM_SQL = """
+    SELECT COUNT(*) AS cnt, BIT_XOR(CRC32(CONCAT_WS('|', operator_number, audio_filename))) AS checksum
+    FROM operator_name_audio
+"""
+OPERATOR_AUDIO_SQL = "SELECT operator_number, audio_filename FROM operator_name_audio"
+MARK_COLUMNS = "am.`id`, am.`calldate`, am.`client_number`, am.`operator_number`, am.`billsec`, am.`queue`, am.`uniqueid`, am.`recordingfile`"
+# Newest NEW mark per client in one round trip. The inner GROUP BY is covered by
+# CREATE INDEX idx_marks_new_window ON autodial_marks (mark_type, callback_status, calldate, client_number, id)
+LAST_CALL_NUMBERS_SQL = """
+    SELECT """ + MARK_COLUMNS + """
+    FROM `autodial_marks` am
+    JOIN (
+        SELECT MAX(`id`) AS id
+        FROM `autodial_marks`
+        WHERE `mark_type` = %s AND {status_clause} AND calldate BETWEEN %s AND %s
+        GROUP BY `client_number`
+    ) latest ON latest.id = am.id
+    ORDER BY am.`id`
+"""
+# Newest mark of the clients waiting longest, one row per client so a batch never dials a number twice
+NUMBERS_FOR_CALL_SQL = """
+    SELECT """ + MARK_COLUMNS + """
+    FROM `autodial_marks` am
+    JOIN (
+        SELECT MAX(`id`) AS id
+        FROM `autodial_marks`
+        WHERE `mark_type` = %s AND {status_clause} AND `calldate` < NOW() - INTERVAL %s SECOND
+        GROUP BY `client_number`
+        ORDER BY MIN(`id`) LIMIT %s
+    ) latest ON latest.id = am.id
+    ORDER BY am.`id`
+"""
+# The time predicates compare the bare column against a constant so an index on it can be range scanned:
+# CREATE INDEX idx_operator_marks_redial ON operator_marks (call_attempts, date_callback)
+REDIAL_NUMBERS_SQL = """
+    SELECT `client_number`, `operator_number`, `date_callback`, `queue`, `evaluated_call_id`, `mark_type`, `callback_status`
+    FROM `operator_marks`
+    WHERE `call_attempts` = 1 AND `callback_status` != 'INITED'
+    AND `callback_status` != 'ANSWERED' AND `date_callback` < NOW() - INTERVAL %s SECOND LIMIT %s
+"""
+# Incremental reader: NEW rows above the watermark, a range on
+# CREATE INDEX idx_marks_new_id ON autodial_marks (mark_type, callback_status, id)
+NEW_MARKS_AFTER_SQL = """
+    SELECT """ + MARK_COLUMNS + """, NOW() AS db_now
+    FROM `autodial_marks` am
+    WHERE am.`mark_type` = %s AND am.`callback_status` = 'NEW' AND am.`id` > %s
+    ORDER BY am.`id` LIMIT %s
+"""
+NEW_MARK_IDS_SQL = "SELECT `id` FROM `autodial_marks` WHERE `callback_status` = 'NEW' AND `id` IN ({placeholders})"
+CALL_UNIQUEID_SQL = "SELECT uniqueid FROM `autodial_marks` WHERE `id` = %s LIMIT 1"
+REDIAL_INITED_SQL = "UPDATE `operator_marks` SET `callback_status` = 'INITED' WHERE `evaluated_call_id` IN ({placeholders})"
+# Redials Asterisk did not take get their previous status back
+REDIAL_RESTORE_SQL = "UPDATE `operator_marks` SET `callback_status` = %s WHERE `evaluated_call_id` = %s AND `callback_status` = 'INITED'"
+INSERT_OPERATOR_MARKS_SQL = """
+    INSERT INTO `operator_marks`
+    (`calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `evaluated_call_id`, `mark_type`, `recordingfile`)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+LAST_CALL_PROCESSED_SQL = """
+    UPDATE `autodial_marks`
+    SET `callback_status` = 'PROCESSED'
+    WHERE `mark_type` = %s
+    AND calldate BETWEEN %s AND %s
+    AND `client_number` IN ({placeholders})
+"""
+CALL_PROCESSED_SQL = """
+    UPDATE `autodial_marks`
+    SET `callback_status` = 'PROCESSED'
+    WHERE `mark_type` = %s
+    AND `client_number` IN ({placeholders})
+"""
+# Marks whose call never reached Asterisk: the dispatched mark goes back to NEW, its client's older marks stay
+# PROCESSED, the next tick picks the client up again through the newest one
+UNDISPATCHED_OPERATOR_MARKS_SQL = "DELETE FROM `operator_marks` WHERE `mark_type` = %s AND `evaluated_call_id` IN ({placeholders})"
+UNDISPATCHED_MARKS_SQL = "UPDATE `autodial_marks` SET `callback_status` = 'NEW' WHERE `id` IN ({placeholders})"
 
 class Autodialer:
-    def __init__(self):
+    def __init__(self, config_path='/opt/pydialer/config.ini'):
         self.config = configparser.ConfigParser()
-        self.config.read('/opt/pydialer/config.ini')
+        self.config.read(config_path)
 
         self.file_handler = file_handler("autodial_marks")
         self.redial = True
         self.redials_timeout = 600
         self.debug_status = True
+        self.batch_dispatch = self.config.getboolean('autodial_marks', 'batch_dispatch', fallback=False)
+        self.redial_batch_size = self.config.getint('autodial_marks', 'redial_batch_size', fallback=50)
+        self.last_max_mark_id = None
+        self.claim_rows = self.config.getboolean('autodial_marks', 'claim_rows', fallback=False)
+        self.concurrent_handlers = self.config.getboolean('autodial_marks', 'concurrent_handlers', fallback=False)
+        self.handler_wait = self.config.getfloat('autodial_marks', 'handler_wait', fallback=1)
+        self.backlog_interval = self.config.getfloat('metrics', 'backlog_interval', fallback=30)
+        self.backlog_checked_at = None
+
+        self.logger = Logger(
+            self.file_handler, self.debug_status,
+            console=self.config.getboolean('logging', 'console', fallback=True),
+            json_lines=self.config.getboolean('logging', 'json', fallback=False),
+            max_list_items=self.config.getint('logging', 'max_list_items', fallback=10)
+        )
+        self.metrics = Metrics.from_config(self.config, self.logger)
 
-        self.con = pymysql.connect(
-            host=self.config['mysql']['host'],
-            user=self.config['mysql']['user'],
-            password=self.config['mysql']['password'],
-            database=self.config['mysql']['database'],
-            charset='utf8',
-            cursorclass=pymysql.cursors.DictCursor,
+        self.db = ConnectionManager.from_config(
+            self.config, self.logger,
+            cursorclass=self.metrics.cursor_class(pymysql.cursors.DictCursor),
             autocommit=True
         )
+        self.con = self.db.connection()
+        self.metrics.register(self.db.collect_metrics)
+
+        # Concurrent mode: every handler runs in its own thread on its own pooled connection
+        self.executor = None
+        self.pool = None
+        self.running = {}
+        if self.concurrent_handlers:
+            self.pool = ConnectionPool(lambda: ConnectionManager.from_config(
+                self.config, self.logger,
+                cursorclass=self.metrics.cursor_class(pymysql.cursors.DictCursor),
+                autocommit=True
+            ), size=len(DispatchLocks.priorities))
+            self.executor = ThreadPoolExecutor(max_workers=len(DispatchLocks.priorities), thread_name_prefix='marks')
+            self.metrics.register(self.pool.collect_metrics)
+
+        self.config_cache = ConfigCache(self.logger, {
+            table: self.config.getfloat('config_cache_ttl', table, fallback=ttl)
+            for table, ttl in ConfigCache.default_ttls.items()
+        })
+        self.metrics.register(self.config_cache.collect_metrics)
+        self.operator_audio = OperatorAudioCache(
+            self.logger, self.config.getfloat('autodial_marks', 'operator_audio_check_interval', fallback=60))
+        self.claims = None
+        if self.claim_rows:
+            self.claims = MarkClaims(
+                self.logger,
+                worker_id=self.config.get('autodial_marks', 'worker_id', fallback=None),
+                lease_seconds=self.config.getint('autodial_marks', 'claim_lease', fallback=120),
+                claim_limit=self.config.getint('autodial_marks', 'claim_limit', fallback=100)
+            )
+        self.capacity = CapacityTracker(
+            self.logger,
+            ttl=self.config.getfloat('autodial_marks', 'capacity_ttl', fallback=2),
+            settle=self.config.getfloat('autodial_marks', 'capacity_settle', fallback=5)
+        )
+        self.metrics.register(self.capacity.collect_metrics)
+        operator_prefixes = OperatorPrefixes.from_config(self.config)
+        self.spool_monitor = SpoolMonitor(
+            self.logger, '/var/spool/asterisk/outgoing', operator_prefixes, self.metrics,
+            scan_interval=self.config.getfloat('autodial_marks', 'spool_scan_interval', fallback=1),
+            max_pending=self.config.getint('autodial_marks', 'spool_max_pending', fallback=0),
+            max_depth=self.config.getint('autodial_marks', 'spool_max_depth', fallback=0)
+        )
+        self.metrics.register(self.spool_monitor.collect_metrics)
+        self.originator = None
+        if self.config.get('autodial_marks', 'dispatch_backend', fallback='callfile') == 'ami':
+            self.originator = AmiOriginator.from_config(self.config, self.logger, self.metrics)
+            self.metrics.register(self.originator.collect_metrics)
+            atexit.register(self.originator.close)
+        self.call_process = CallProcess(self.logger, self.config_cache, self.operator_audio,
+                                        operator_prefixes, self.metrics, self.capacity, self.spool_monitor, self.originator)
+        self.last_call_handler = LastCallHandler(self.call_process, self.logger, self.config_cache, self.claims)
+        self.call_handler = CallHandler(self.call_process, self.logger, self.config_cache, self.batch_dispatch, self.claims,
+                                        self.pending_marks())
+        self.redial_call_handler = Redial(self.call_process, self.logger, self.config_cache, self.redials_timeout,
+                                          self.batch_dispatch, self.redial_batch_size, self.claims)
+        self.scheduler = AdaptiveScheduler(
+            self.logger,
+            min_interval=self.config.getfloat('autodial_marks', 'min_interval', fallback=1),
+            max_interval=self.config.getfloat('autodial_marks', 'max_interval', fallback=30),
+            backoff_factor=self.config.getfloat('autodial_marks', 'backoff_factor', fallback=2),
+            wake_fifo=self.config.get('autodial_marks', 'wake_fifo', fallback=None),
+            probe_interval=self.config.getfloat('autodial_marks', 'probe_interval', fallback=0)
+        )
 
-        self.logger = Logger(self.file_handler, self.debug_status, self.con)
-        self.call_process = CallProcess(self.logger, self.con)
-        self.last_call_handler = LastCallHandler(self.call_process, self.logger)
-        self.call_handler = CallHandler(self.call_process, self.logger)
-        self.redial_call_handler = Redial(self.call_process, self.logger, self.con, self.redials_timeout)
+    def pending_marks(self):
+        # [autodial_marks] incremental_marks = true; claimed rows are shared with other workers, so it needs claim_rows off
+        if not self.config.getboolean('autodial_marks', 'incremental_marks', fallback=False):
+            return None
+        if self.claims:
+            self.logger.warning("incremental_marks is ignored with claim_rows enabled")
+            return None
+        return {mark_type: PendingMarks.from_config(self.config, mark_type) for mark_type in ('incoming', 'manual_out')}
 
     def run(self):
+        # kill -HUP drops cached settings so edits in the admin panel apply on the next tick
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.config_cache.invalidate())
+        self.metrics.start()
         while True:
-            time.sleep(5)
+            self.scheduler.wait(self.probe_new_marks)
+            try:
+                self.db.connection()
+            except pymysql.err.MySQLError as e:
+                # Retries are spent, back off and try again next tick instead of exiting
+                self.logger.error(f"MySQL is unavailable, skipping tick: {e}")
+                self.scheduler.update(0)
+                continue
             with self.con.cursor() as cur:
-                self.process_marks(cur)
+                with self.metrics.timer('autodial_tick_seconds'):
+                    dispatched = self.process_marks(cur)
+                if self.metrics.enabled:
+                    self.collect_backlog(cur)
+            self.scheduler.update(dispatched)
+            self.metrics.set('autodial_scheduler_interval_seconds', self.scheduler.interval)
+            self.metrics.export()
 
     def process_marks(self, cur):
         mark_settings = self.get_mark_settings(cur)
+        if not mark_settings:
+            return 0
+        if self.claims:
+            self.claims.reclaim_expired(cur)
 
-        if mark_settings['enable_last_call']:
-            self.last_call_handler.handle_last_call(cur, 'last_call')
-        if mark_settings['enable_last_call_out']:
-            self.last_call_handler.handle_last_call(cur, 'last_call_out')
+        # Most urgent first: customers who just hung up wait least, bulk last_call work goes last
+        handlers = []
         if mark_settings['enable_incoming']:
-            self.call_handler.handle_call(cur, 'incoming')
+            handlers.append(('incoming', self.call_handler.handle_call, ('incoming',)))
         if mark_settings['enable_manual_out']:
-            self.call_handler.handle_call(cur, 'manual_out')
+            handlers.append(('manual_out', self.call_handler.handle_call, ('manual_out',)))
         if self.redial:
-            self.redial_call_handler.redial_handle_call(cur)
+            handlers.append(('redial', self.redial_call_handler.redial_handle_call, ()))
+        if mark_settings['enable_last_call']:
+            handlers.append(('last_call', self.last_call_handler.handle_last_call, ('last_call',)))
+        if mark_settings['enable_last_call_out']:
+            handlers.append(('last_call_out', self.last_call_handler.handle_last_call, ('last_call_out',)))
+
+        if self.executor is None:
+            return sum(self.run_handler(cur, name, handle, args) for name, handle, args in handlers)
+        return self.run_handlers_concurrently(handlers)
+
+    def run_handler(self, cur, name, handle, args):
+        # A failing handler loses its own turn, the other handlers and the next tick still run
+        try:
+            with self.metrics.timer('autodial_handler_seconds', handler=name):
+                return handle(cur, *args)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            # wait_timeout or a MySQL restart mid tick: the next tick pings and reconnects
+            self.logger.error(f"Handler {name} lost the MySQL connection: {e}")
+            self.db.invalidate()
+            return 0
+        except Exception as e:
+            self.logger.error(f"Handler {name} failed: {e}")
+            return 0
+
+    def run_pooled_handler(self, name, handle, args):
+        try:
+            with self.pool.connection() as con, con.cursor() as cur:
+                return self.run_handler(cur, name, handle, args)
+        except Exception as e:
+            self.logger.error(f"Handler {name} failed: {e}")
+            return 0
+
+    def run_handlers_concurrently(self, handlers):
+        # A handler still busy from an earlier tick keeps running and is not started again, so a long
+        # last_call scan never holds back the next incoming pass. The tick waits at most handler_wait
+        # seconds and counts whatever has finished by then.
+        for name, handle, args in handlers:
+            if name not in self.running:
+                self.running[name] = self.executor.submit(self.run_pooled_handler, name, handle, args)
+
+        wait(list(self.running.values()), timeout=self.handler_wait)
+        dispatched = 0
+        for name, future in list(self.running.items()):
+            if future.done():
+                del self.running[name]
+                dispatched += future.result()
+        return dispatched
+
+    def collect_backlog(self, cur):
+        # Extra COUNT query, so it only runs with metrics enabled and at most every backlog_interval seconds
+        now = time.monotonic()
+        if self.backlog_checked_at is not None and now - self.backlog_checked_at < self.backlog_interval:
+            return
+        self.backlog_checked_at = now
+        try:
+            cur.execute("SELECT `mark_type`, COUNT(*) AS cnt FROM `autodial_marks` WHERE callback_status = 'NEW' GROUP BY `mark_type`")
+            backlog = {row['mark_type']: row['cnt'] for row in cur.fetchall()}
+        except Exception as e:
+            self.logger.error(f"Error while counting the NEW backlog: {e}")
+            return
+        for mark_type in ('last_call', 'last_call_out', 'incoming', 'manual_out'):
+            self.metrics.set('autodial_new_backlog', backlog.pop(mark_type, 0), mark_type=mark_type)
+        for mark_type, count in backlog.items():
+            self.metrics.set('autodial_new_backlog', count, mark_type=mark_type)
+
+    def probe_new_marks(self):
+        # Cheap primary key probe used by the scheduler to cut a back-off short when new marks arrive
+        try:
+            with self.con.cursor() as cur:
+                cur.execute("SELECT MAX(`id`) AS max_id FROM `autodial_marks`")
+                result = cur.fetchone()
+        except Exception as e:
+            self.logger.error(f"Error while probing autodial_marks for new rows: {e}")
+            return False
+
+        max_id = result['max_id'] if result else None
+        changed = self.last_max_mark_id is not None and max_id != self.last_max_mark_id
+        self.last_max_mark_id = max_id
+        return changed
 
     def get_mark_settings(self, cur):
         try:
-            query = """
-                SELECT MAX(CASE WHEN calls_type = 'last_call' THEN enable END) AS enable_last_call,
-                   MAX(CASE WHEN calls_type = 'incoming' THEN enable END) AS enable_incoming,
-                   MAX(CASE WHEN calls_type = 'manual_out' THEN enable END) AS enable_manual_out,
-                   MAX(CASE WHEN calls_type = 'last_call_out' THEN enable END) AS enable_last_call_out
-            FROM operator_marks_setting
-            WHERE calls_type IN ('last_call', 'incoming', 'manual_out', 'last_call_out')
-            """
-            cur.execute(query)
-            return cur.fetchone()
+            return self.config_cache.get_mark_settings(cur)
         except Exception as e:
             self.logger.error(f"Error while getting the list of active ratings: {e}")
             return None
 
+def mark_status_filter(claims):
+    # Rows this worker may dispatch: its own claims when claiming is on, otherwise every NEW row
+    if claims:
+        return "callback_status = 'CLAIMED' AND worker_id = %s", (claims.worker_id,)
+    return "callback_status = 'NEW'", ()
+
+class PendingMarks:
+    # Incremental reader for one mark type. NEW rows are read once, above an id watermark, and wait in memory
+    # ordered by calldate until calldate + sleeptime has passed, so a steady tick only touches rows added
+    # since the last one. Due rows are checked by primary key before they are handed out, rows processed
+    # elsewhere drop out there. Every resync_interval seconds the watermark goes back to 0 to pick up rows
+    # committed out of id order or set back to NEW by hand.
+    def __init__(self, mark_type, fetch_limit=1000, max_pending=10000, resync_interval=300):
+        self.mark_type = mark_type
+        self.fetch_limit = fetch_limit
+        self.max_pending = max_pending
+        self.resync_interval = resync_interval
+        self.watermark = 0
+        self.synced_at = None
+        # (calldate, id) heap over rows; an id missing from rows is a dropped entry
+        self.heap = []
+        self.rows = {}
+        self.clients = {}
+        # MySQL NOW() minus the local clock, calldate is compared on the database clock
+        self.skew = timedelta(0)
+
+    @classmethod
+    def from_config(cls, config, mark_type, section='autodial_marks'):
+        return cls(
+            mark_type,
+            fetch_limit=config.getint(section, 'incremental_fetch_limit', fallback=1000),
+            max_pending=config.getint(section, 'incremental_max_pending', fallback=10000),
+            resync_interval=config.getfloat(section, 'incremental_resync_interval', fallback=300)
+        )
+
+    def fetch_params(self):
+        # Next page to read, None while the queue is full
+        now = time.monotonic()
+        if self.synced_at is None or now - self.synced_at >= self.resync_interval:
+            self.synced_at = now
+            self.watermark = 0
+        if len(self.rows) >= self.max_pending:
+            return None
+        return self.mark_type, self.watermark, self.fetch_limit
+
+    def add(self, rows):
+        # True when the page was full and there may be more to read
+        for row in rows:
+            self.skew = row.pop('db_now') - datetime.now()
+            self.watermark = max(self.watermark, row['id'])
+            if row['id'] in self.rows:
+                continue
+            self.rows[row['id']] = row
+            self.clients.setdefault(row['client_number'], set()).add(row['id'])
+            heapq.heappush(self.heap, (row['calldate'], row['id']))
+        return len(rows) == self.fetch_limit
+
+    def due(self, sleeptime, limit):
+        # Newest due row of each of the first `limit` clients in calldate order, the same pick as
+        # NUMBERS_FOR_CALL_SQL. Nothing is removed, rows leave once they are no longer NEW.
+        cutoff = datetime.now() + self.skew - timedelta(seconds=sleeptime)
+        popped = []
+        chosen = []
+        while self.heap and self.heap[0][0] < cutoff and len(chosen) < limit:
+            entry = heapq.heappop(self.heap)
+            row = self.rows.get(entry[1])
+            if row is None:
+                continue
+            popped.append(entry)
+            if any(row['client_number'] == number['client_number'] for number in chosen):
+                continue
+            chosen.append(max(
+                (self.rows[mark_id] for mark_id in self.clients[row['client_number']] if self.rows[mark_id]['calldate'] < cutoff),
+                key=lambda number: number['id']
+            ))
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return sorted(chosen, key=lambda number: number['id'])
+
+    def validate(self, chosen, new_ids):
+        # Keeps the rows still NEW. A processed row means every older mark of its client was processed with it
+        stale = [number for number in chosen if number['id'] not in new_ids]
+        for number in stale:
+            for mark_id in [mark_id for mark_id in self.clients.get(number['client_number'], ()) if mark_id <= number['id']]:
+                self.discard(mark_id)
+        return [number for number in chosen if number['id'] in new_ids], bool(stale)
+
+    def discard(self, mark_id):
+        row = self.rows.pop(mark_id)
+        ids = self.clients[row['client_number']]
+        ids.discard(mark_id)
+        if not ids:
+            del self.clients[row['client_number']]
+
+    def numbers(self, cur, sleeptime, limit):
+        params = self.fetch_params()
+        while params:
+            cur.execute(NEW_MARKS_AFTER_SQL, params)
+            params = self.add(list(cur.fetchall())) and self.fetch_params()
+
+        # Refill after stale rows are dropped, every round discards at least one row so this ends
+        numbers = []
+        while len(numbers) < limit:
+            taken = {number['id'] for number in numbers}
+            chosen = [number for number in self.due(sleeptime, limit) if number['id'] not in taken]
+            if not chosen:
+                break
+            cur.execute(NEW_MARK_IDS_SQL.format(placeholders=', '.join(['%s'] * len(chosen))), [number['id'] for number in chosen])
+            valid, stale = self.validate(chosen, {row['id'] for row in cur.fetchall()})
+            numbers.extend(valid)
+            if not stale:
+                break
+        return numbers
+
+class MarkClaims:
+    # Lets several Autodialer processes share autodial_marks without dialing a client twice.
+    # Requires MySQL 8.0+ / MariaDB 10.6+ (SKIP LOCKED) and:
+    #   ALTER TABLE autodial_marks ADD COLUMN worker_id VARCHAR(64) NULL, ADD COLUMN claimed_at DATETIME NULL,
+    #       ADD INDEX idx_marks_claims (callback_status, worker_id, mark_type), ADD INDEX idx_marks_claimed_at (callback_status, claimed_at);
+    def __init__(self, logger, worker_id=None, lease_seconds=120, claim_limit=100):
+        self.logger = logger
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.claim_limit = claim_limit
+        self.reclaimed_at = None
+
+    def claim(self, cur, mark_type, condition, params, limit):
+        try:
+            cur.connection.begin()
+            cur.execute(f"""
+                SELECT `client_number`
+                FROM `autodial_marks`
+                WHERE `mark_type` = %s AND callback_status = 'NEW' AND {condition}
+                ORDER BY `id` LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (mark_type, *params, limit))
+            client_numbers = list({row['client_number'] for row in cur.fetchall()})
+
+            claimed = 0
+            if client_numbers:
+                # Take every matching row of these clients, so no other worker can pick up a duplicate mark
+                placeholders = ', '.join(['%s'] * len(client_numbers))
+                claimed = cur.execute(f"""
+                    UPDATE `autodial_marks`
+                    SET callback_status = 'CLAIMED', worker_id = %s, claimed_at = NOW()
+                    WHERE `mark_type` = %s AND callback_status = 'NEW' AND {condition}
+                    AND `client_number` IN ({placeholders})
+                """, (self.worker_id, mark_type, *params, *client_numbers))
+            cur.connection.commit()
+            return claimed
+        except Exception as e:
+            self.logger.error(f"Error while claiming marks for rating '{mark_type}': {e}")
+            cur.connection.rollback()
+            return 0
+
+    def release(self, cur, mark_type):
+        try:
+            cur.execute("""
+                UPDATE `autodial_marks`
+                SET callback_status = 'NEW', worker_id = NULL, claimed_at = NULL
+                WHERE callback_status = 'CLAIMED' AND worker_id = %s AND `mark_type` = %s
+            """, (self.worker_id, mark_type))
+        except Exception as e:
+            self.logger.error(f"Error while releasing claimed marks for rating '{mark_type}': {e}")
+
+    def reclaim_expired(self, cur):
+        now = time.monotonic()
+        if self.reclaimed_at is not None and now - self.reclaimed_at < self.lease_seconds / 2:
+            return
+        self.reclaimed_at = now
+        try:
+            reclaimed = cur.execute("""
+                UPDATE `autodial_marks`
+                SET callback_status = 'NEW', worker_id = NULL, claimed_at = NULL
+                WHERE callback_status = 'CLAIMED' AND claimed_at < NOW() - INTERVAL %s SECOND
+            """, (self.lease_seconds,))
+            if reclaimed:
+                self.logger.warning(f"Returned {reclaimed} marks with an expired claim back to NEW")
+        except Exception as e:
+            self.logger.error(f"Error while reclaiming expired marks: {e}")
+
+    def acquire_lock(self, cur, name):
+        # Flows without a claim column are serialized across workers with a MySQL named lock
+        try:
+            cur.execute("SELECT GET_LOCK(%s, 0) AS locked", (name,))
+            result = cur.fetchone()
+            return bool(result and result['locked'])
+        except Exception as e:
+            self.logger.error(f"Error while acquiring lock '{name}': {e}")
+            return False
+
+    def release_lock(self, cur, name):
+        try:
+            cur.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        except Exception as e:
+            self.logger.error(f"Error while releasing lock '{name}': {e}")
+
+class ConfigCache:
+    # Seconds each table is trusted before it is re-read
+    default_ttls = {
+        'operator_marks_setting': 60,
+        'config_queue_callbacks': 300,
+        'config_agent_marks': 300,
+    }
+
+    def __init__(self, logger, ttls=None):
+        self.logger = logger
+        self.ttls = dict(self.default_ttls)
+        if ttls:
+            self.ttls.update(ttls)
+        # table -> (query, rows -> cached value)
+        self.loaders = {
+            'operator_marks_setting': (MARK_SETTINGS_SQL, self.group_mark_settings),
+            'config_queue_callbacks': (QUEUE_CALLBACKS_SQL, self.map_queue_branches),
+            'config_agent_marks': (AGENT_MARKS_SQL, self.map_agent_branches),
+        }
+        self.tables = {}
+        self.loaded_at = {}
+        self.hits = dict.fromkeys(self.loaders, 0)
+        self.misses = dict.fromkeys(self.loaders, 0)
+        # Concurrent handlers share the cache, an expired table is reloaded by one of them only
+        self.lock = threading.RLock()
+
+    def get(self, cur, table):
+        with self.lock:
+            if not self.expired(table):
+                self.hits[table] += 1
+                return self.tables[table]
+
+            query, build = self.loaders[table]
+            cur.execute(query)
+            return self.store(table, build(cur.fetchall()))
+
+    def expired(self, table):
+        loaded_at = self.loaded_at.get(table)
+        return loaded_at is None or time.monotonic() - loaded_at >= self.ttls[table]
+
+    def store(self, table, value):
+        self.misses[table] += 1
+        self.tables[table] = value
+        self.loaded_at[table] = time.monotonic()
+        return value
+
+    def invalidate(self, table=None):
+        if table is None:
+            self.loaded_at.clear()
+        else:
+            self.loaded_at.pop(table, None)
+
+    def stats(self):
+        return {table: {'hits': self.hits[table], 'misses': self.misses[table]} for table in self.loaders}
+
+    def collect_metrics(self, metrics):
+        for table in self.loaders:
+            metrics.set('autodial_config_cache_hits', self.hits[table], table=table)
+            metrics.set('autodial_config_cache_misses', self.misses[table], table=table)
+
+    @staticmethod
+    def group_mark_settings(rows):
+        # operator_marks_setting and its department come in a single query, grouped by calls_type
+        settings = {}
+        for row in rows:
+            settings.setdefault(row['calls_type'], []).append(row)
+        return settings
+
+    @staticmethod
+    def map_queue_branches(rows):
+        return {row['queue_name']: row['mark_ivr_menu'] for row in rows}
+
+    @staticmethod
+    def map_agent_branches(rows):
+        return {row['sip']: row['queue_ivr_branch'] for row in rows}
+
+    def get_mark_settings(self, cur):
+        settings = self.get(cur, 'operator_marks_setting')
+        mark_settings = {}
+        for call_type in ('last_call', 'incoming', 'manual_out', 'last_call_out'):
+            enabled = [row['enable'] for row in settings.get(call_type, []) if row['enable'] is not None]
+            mark_settings[f"enable_{call_type}"] = max(enabled) if enabled else None
+        return mark_settings
+
+    def get_setting(self, cur, call_type):
+        rows = self.get(cur, 'operator_marks_setting').get(call_type)
+        return rows[0] if rows else None
+
+    def get_call_settings(self, cur, call_type):
+        # Same contract as the old inner JOIN: no department, no settings
+        for row in self.get(cur, 'operator_marks_setting').get(call_type, []):
+            if row['dep_id'] is not None:
+                return row
+        return None
+
+    def get_queue_ivr_branch(self, cur, queue_name):
+        return self.get(cur, 'config_queue_callbacks').get(queue_name)
+
+    def get_agent_ivr_branch(self, cur, sip):
+        return self.get(cur, 'config_agent_marks').get(sip)
+
+class OperatorAudioCache:
+    def __init__(self, logger, check_interval=60):
+        self.logger = logger
+        self.check_interval = check_interval
+        self.audio = {}
+        self.signature = None
+        self.checked_at = None
+        self.warned = set()
+        self.lock = threading.RLock()
+
+    def refresh(self, cur, force=False):
+        # The roster rarely changes, so compare a checksum first and only reload the table when it differs
+        with self.lock:
+            if not self.due(force):
+                return
+            cur.execute(OPERATOR_AUDIO_CHECKSUM_SQL)
+            signature = self.signature_of(cur.fetchone())
+            if signature == self.signature and not force:
+                return
+            cur.execute(OPERATOR_AUDIO_SQL)
+            self.load(cur.fetchall(), signature)
+
+    def due(self, force):
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+        return True
+
+    @staticmethod
+    def signature_of(result):
+        return (result['cnt'], result['checksum']) if result else None
+
+    def load(self, rows, signature):
+        audio = {}
+        for row in rows:
+            audio.setdefault(str(row['operator_number']), row['audio_filename'])
+        self.audio = audio
+        self.signature = signature
+        self.warned.clear()
+        self.logger.info(f"Loaded {len(audio)} operator name audio files")
+
+    def get(self, cur, operator_number):
+        self.refresh(cur)
+        return self.lookup(operator_number)
+
+    def lookup(self, operator_number):
+        audio_filename = self.audio.get(str(operator_number))
+        if audio_filename is None and operator_number not in self.warned:
+            self.warned.add(operator_number)
+            self.logger.warning(f"Say_fio is enabled, but no audio filename found for operator number: '{operator_number}'")
+        return audio_filename
+
+class OperatorPrefixes:
+    default_prefixes = {
+        'mts': ('+38066', '+38095', '+38050'),
+        'ks': ('+38067', '+38068', '+38096', '+38097', '+38098'),
+        'life': ('+38063', '+38073', '+38093'),
+    }
+
+    def __init__(self, prefixes=None):
+        # Compiled into one prefix -> operator dict, looked up by slicing each known prefix length
+        self.table = {}
+        for oper, operator_prefixes in (prefixes or self.default_prefixes).items():
+            for prefix in operator_prefixes:
+                self.table[prefix] = oper
+        self.lengths = sorted({len(prefix) for prefix in self.table}, reverse=True)
+
+    @classmethod
+    def from_config(cls, config, section='operator_prefixes'):
+        # [operator_prefixes]
+        # mts = +38066, +38095, +38050
+        if not config.has_section(section):
+            return cls()
+        return cls({
+            oper: tuple(prefix.strip() for prefix in value.split(',') if prefix.strip())
+            for oper, value in config.items(section)
+        })
+
+    def classify(self, client_number):
+        for length in self.lengths:
+            oper = self.table.get(client_number[:length])
+            if oper:
+                return oper
+        return 'unknown'
+
+    def classify_many(self, client_numbers):
+        if len(self.lengths) == 1:
+            length = self.lengths[0]
+            get = self.table.get
+            return [get(client_number[:length], 'unknown') for client_number in client_numbers]
+        return [self.classify(client_number) for client_number in client_numbers]
+
+class AdaptiveScheduler:
+    def __init__(self, logger, min_interval=1, max_interval=30, backoff_factor=2, wake_fifo=None, probe_interval=0):
+        self.logger = logger
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.probe_interval = probe_interval
+        self.interval = min_interval
+        self.fifo_fd = None
+        self.fifo_keepalive_fd = None
+        if wake_fifo:
+            self.open_fifo(wake_fifo)
+
+    def open_fifo(self, path):
+        try:
+            if not os.path.exists(path):
+                os.mkfifo(path, 0o660)
+            self.fifo_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            # Holding our own writer keeps select() from spinning on EOF once an external writer closes
+            self.fifo_keepalive_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            self.logger.error(f"Failed to open wake FIFO '{path}', falling back to polling: {e}")
+            self.fifo_fd = None
+
+    def update(self, dispatched):
+        if dispatched:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff_factor, self.max_interval)
+        self.logger.debug("Dispatched %s calls, next tick in %ss", dispatched, self.interval)
+        return self.interval
+
+    def wait(self, probe=None):
+        deadline = time.monotonic() + self.interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            step = remaining
+            if probe and self.probe_interval:
+                step = min(step, self.probe_interval)
+
+            if self.fifo_fd is not None:
+                readable, _, _ = select.select([self.fifo_fd], [], [], step)
+                if readable:
+                    self.drain_fifo()
+                    self.logger.debug("Woken up by external signal")
+                    return True
+            else:
+                time.sleep(step)
+
+            if probe and self.probe_interval and probe():
+                self.logger.debug("New marks detected, waking up")
+                return True
+
+    def drain_fifo(self):
+        try:
+            while os.read(self.fifo_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class ListSummary:
+    # Logged in place of a whole batch: its size and the first few items, optionally reduced to one field
+    __slots__ = ('items', 'key', 'limit')
+
+    def __init__(self, items, key=None, limit=10):
+        self.items = items
+        self.key = key
+        self.limit = limit
+
+    def __str__(self):
+        items = self.items if not self.limit else self.items[:self.limit]
+        shown = [item[self.key] for item in items] if self.key else list(items)
+        if len(items) == len(self.items):
+            return f"{len(self.items)} items: {shown}"
+        return f"{len(self.items)} items, first {len(items)}: {shown}"
+
+class InProcessQueueHandler(QueueHandler):
+    # The stock prepare() formats the message and drops args in the calling thread so the record can be pickled.
+    # The queue never leaves the process, so the record goes through as is and the listener formats it
+    def prepare(self, record):
+        return record
+
 class Logger:
-    def __init__(self, logger, debug_status, con):
+    def __init__(self, logger, debug_status, console=True, json_lines=False, max_list_items=10):
         self.logger = logger
         self.debug_status = debug_status
-        self.con = con
-        self.cur = con.cursor()
-
-    def debug(self, message):
+        self.max_list_items = max_list_items
+
+        # The handlers from create_logger move behind a queue: the dispatch loop only enqueues the unformatted
+        # record, message formatting and disk writes happen in the listener thread
+        handlers = list(logger.handlers)
+        for handler in handlers:
+            logger.removeHandler(handler)
+            if handler.level == logging.NOTSET:
+                handler.setLevel(logging.INFO)  # debug messages have always been console only
+            if json_lines:
+                handler.setFormatter(JsonLinesFormatter())
+        if console:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter('%(message)s'))
+            handlers.append(console_handler)
+
+        records = queue.SimpleQueue()
+        logger.setLevel(logging.DEBUG if debug_status else logging.INFO)
+        logger.addHandler(InProcessQueueHandler(records))
+        self.listener = QueueListener(records, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.close)
+
+    def close(self):
+        # Flushes whatever is still queued, safe to call more than once
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    # Messages take %-style args, formatted only when the level is enabled; keyword arguments
+    # become extra fields of the JSON line
+    def log(self, level, message, args, fields):
+        self.logger.log(level, message, *args, extra={'fields': fields} if fields else None)
+
+    def debug(self, message, *args, **fields):
         if self.debug_status:
-            print(message)
+            self.log(logging.DEBUG, message, args, fields)
+
+    def info(self, message, *args, **fields):
+        self.log(logging.INFO, message, args, fields)
 
-    def info(self, message):
-        print(message)
-        self.logger.info(message)
+    def warning(self, message, *args, **fields):
+        self.log(logging.WARNING, message, args, fields)
 
-    def warning(self, message):
-        print(message)
-        self.logger.warning(message)
+    def error(self, message, *args, **fields):
+        self.log(logging.ERROR, message, args, fields)
 
-    def error(self, message):
-        print(message)
-        self.logger.error(message)
+    def summary(self, items, key=None):
+        return ListSummary(items, key, self.max_list_items)
 
 class LastCallHandler:
-    def __init__(self, call_process, logger):
+    def __init__(self, call_process, logger, config_cache, claims=None):
         self.logger = logger
         self.call_process = call_process
+        self.config_cache = config_cache
+        self.claims = claims
 
     def handle_last_call(self, cur, call_type):
-        self.logger.debug(f"Mark {call_type} is start")
+        self.logger.debug("Mark %s is start", call_type)
         settings = self.get_call_settings(cur, call_type)
         if settings:
-            current_time = datetime.now().time()
-            shift_start_time = datetime.strptime(str(settings['agent_shift_start']), '%H:%M:%S').time()
-            shift_end_time = datetime.strptime(str(settings['agent_shift_end']), '%H:%M:%S').time()
-            never_call_after_time = datetime.strptime(str(settings['never_call_after']), '%H:%M:%S').time()
-
-            if shift_start_time <= current_time <= shift_end_time:
-                start_time, end_time = self.get_shift_time_range(settings)
-            elif shift_end_time < current_time <= never_call_after_time:
-                start_time, end_time = self.get_after_shift_time_range(settings)
-
+            start_time, end_time = self.get_time_range(settings)
             if start_time and end_time:
-                self.process_last_call_details(cur, call_type, settings, start_time, end_time)
+                return self.process_last_call_details(cur, call_type, settings, start_time, end_time)
         else:
                 self.logger.error(f"Failed to get call settings for call type: {call_type}")
+        return 0
+
+    def get_time_range(self, settings):
+        # Window of marks to call back right now, (None, None) outside the calling hours
+        current_time = datetime.now().time()
+        shift_start_time = datetime.strptime(str(settings['agent_shift_start']), '%H:%M:%S').time()
+        shift_end_time = datetime.strptime(str(settings['agent_shift_end']), '%H:%M:%S').time()
+        never_call_after_time = datetime.strptime(str(settings['never_call_after']), '%H:%M:%S').time()
+
+        if shift_start_time <= current_time <= shift_end_time:
+            return self.get_shift_time_range(settings)
+        if shift_end_time < current_time <= never_call_after_time:
+            return self.get_after_shift_time_range(settings)
+        return None, None
 
     def get_call_settings(self, cur, call_type):
         try:
-            query = """
-                SELECT oms.agent_shift_start, oms.agent_shift_end, oms.never_call_after, d.id AS dep_id, d.callerid
-                FROM operator_marks_setting oms
-                JOIN departaments d ON d.name = oms.dep_name
-                WHERE oms.calls_type = %s LIMIT 1
-            """
-            cur.execute(query, (call_type,))
-            return cur.fetchone()
+            return self.config_cache.get_call_settings(cur, call_type)
 
         except Exception as e:
             self.logger.error(f"Error while getting rating settings {call_type}: {e}")
@@ -147,39 +933,38 @@ class LastCallHandler:
         return start_time, end_time
 
     def process_last_call_details(self, cur, call_type, settings, start_time, end_time):
+        if not self.claims:
+            return self.dispatch_last_call_details(cur, call_type, settings, start_time, end_time)
+
+        self.claims.claim(cur, call_type, "calldate BETWEEN %s AND %s", (start_time, end_time), self.claims.claim_limit)
+        try:
+            return self.dispatch_last_call_details(cur, call_type, settings, start_time, end_time)
+        finally:
+            self.claims.release(cur, call_type)
+
+    def dispatch_last_call_details(self, cur, call_type, settings, start_time, end_time):
         detail_information = self.get_last_call_numbers(cur, start_time, end_time, call_type)
         if detail_information:
-            self.logger.info(f"Detail information for call type {call_type}: {detail_information}")
+            self.logger.info("Detail information for call type %s: %s", call_type,
+                             self.logger.summary(detail_information, 'client_number'), call_type=call_type, rows=len(detail_information))
             ivr_branch = self.get_ivr_branch(cur, call_type)
             if ivr_branch:
                 updated_information = self.call_process.assign_operators_to_numbers(detail_information)
-                self.call_process.calc_free_and_process(
+                return self.call_process.calc_free_and_process(
                     updated_information, cur, call_type, ivr_branch,
                     settings['dep_id'], settings['callerid'], start_time, end_time)
             else:
                 self.logger.error(f"Failed to get IVR branch for call type: {call_type}")
         else:
-            self.logger.debug(f"Detail information for call type {call_type} si null")
+            self.logger.debug("Detail information for call type %s si null", call_type)
+        return 0
 
     def get_last_call_numbers(self, cur, start_time, end_time, call_type):
         try:
-            query = f"SELECT DISTINCT client_number FROM autodial_marks WHERE mark_type = %s AND callback_status = 'NEW' AND calldate BETWEEN %s AND %s"
-            cur.execute(query, (call_type, start_time, end_time))
-            numbers = cur.fetchall()
-
-            detail_information = []
-            for number in numbers:
-                cur.execute("""
-                    SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `uniqueid`, `recordingfile`
-                    FROM `autodial_marks`
-                    WHERE `client_number` = %s AND callback_status = 'NEW'
-                    ORDER BY `autodial_marks`.`id` DESC LIMIT 1
-                """, (number['client_number'],))
-                result = cur.fetchone()
-                if result:
-                    detail_information.append(result)
-
-            return detail_information
+            status_clause, status_params = mark_status_filter(self.claims)
+            query = LAST_CALL_NUMBERS_SQL.format(status_clause=status_clause)
+            cur.execute(query, (call_type, *status_params, start_time, end_time))
+            return list(cur.fetchall())
 
         except Exception as e:
             self.logger.error(f"Error while getting numbers for {call_type}: {e}")
@@ -187,133 +972,169 @@ class LastCallHandler:
 
     def get_ivr_branch(self, cur, call_type):
         try:
-            query = "SELECT ivr_branch FROM `operator_marks_setting` WHERE calls_type = %s"
-            cur.execute(query, (call_type,))
-            result = cur.fetchone()
+            result = self.config_cache.get_setting(cur, call_type)
             return result['ivr_branch'] if result else None
         except Exception as e:
             self.logger.error(f"Error while getting the IVR branch for rating {call_type}: {e}")
             return None
 
 class CallHandler:
-    def __init__(self, call_process, logger):
+    def __init__(self, call_process, logger, config_cache, batch_mode=False, claims=None, pending=None):
         self.call_process = call_process
         self.logger = logger
+        self.config_cache = config_cache
+        self.batch_mode = batch_mode
+        self.claims = claims
+        # mark type -> PendingMarks when incremental_marks is on
+        self.pending = pending or {}
 
     def handle_call(self, cur, call_type):
-        self.logger.debug(f"Mark {call_type} is started")
+        self.logger.debug("Mark %s is started", call_type)
         settings = self.get_call_settings(cur, call_type)
         if settings:
-            detail_information = self.get_number_for_call(cur, call_type, settings['sleeptime'])
-            if detail_information:
-                self.logger.info(f"Detail information for call type {call_type}: {detail_information}")
-                ivr_branch = self.get_ivr_branch(cur, call_type, detail_information)
-                if ivr_branch:
-                    updated_information = self.call_process.assign_operators_to_numbers(detail_information)
-                    self.call_process.calc_free_and_process(updated_information, cur, call_type, ivr_branch, settings['dep_id'], settings['callerid'], None, None)
-                else:
-                    self.logger.error(f"Failed to get IVR branch for call type: {call_type}")
-            else:
-                self.logger.debug(f"Detail information for call type {call_type} si null")
+            if not self.batch_mode:
+                return self.claim_and_dispatch(cur, call_type, settings, 1, None)
+
+            # Pull as many numbers as there are free channels instead of one per tick,
+            # holding the department until they are dispatched
+            with self.call_process.dispatch_locks.hold(settings['dep_id'], call_type):
+                free = self.call_process.get_free_sim(cur, settings['dep_id'])
+                limit = self.call_process.free_capacity(free)
+                if not limit:
+                    self.logger.warning(f"No free sim in dep {settings['callerid']}, for call type: {call_type}")
+                    return 0
+                return self.claim_and_dispatch(cur, call_type, settings, limit, free)
         else:
             self.logger.error(f"Failed to get call settings for call type: {call_type}")
+        return 0
+
+    def claim_and_dispatch(self, cur, call_type, settings, limit, free):
+        if not self.claims:
+            return self.dispatch_numbers(cur, call_type, settings, limit, free)
+
+        self.claims.claim(cur, call_type, "`calldate` < NOW() - INTERVAL %s SECOND", (settings['sleeptime'],), limit)
+        try:
+            return self.dispatch_numbers(cur, call_type, settings, limit, free)
+        finally:
+            self.claims.release(cur, call_type)
+
+    def dispatch_numbers(self, cur, call_type, settings, limit, free):
+        detail_information = self.get_numbers_for_call(cur, call_type, settings['sleeptime'], limit)
+        if detail_information:
+            self.logger.info("Detail information for call type %s: %s", call_type,
+                             self.logger.summary(detail_information, 'client_number'), call_type=call_type, rows=len(detail_information))
+            numbers = []
+            for detail in detail_information:
+                detail['ivr_branch'] = self.get_ivr_branch(cur, call_type, detail)
+                if detail['ivr_branch']:
+                    numbers.append(detail)
+                else:
+                    self.logger.error(f"Failed to get IVR branch for call type: {call_type}, number: {detail['client_number']}")
+            if numbers:
+                updated_information = self.call_process.assign_operators_to_numbers(numbers)
+                return self.call_process.calc_free_and_process(updated_information, cur, call_type, None, settings['dep_id'], settings['callerid'], None, None, free)
+        else:
+            self.logger.debug("Detail information for call type %s si null", call_type)
+        return 0
 
     def get_call_settings(self, cur, call_type):
         try:
-            query = """
-                SELECT oms.sleeptime, d.id AS dep_id, d.callerid 
-                FROM operator_marks_setting oms 
-                JOIN departaments d ON d.name = oms.dep_name 
-                WHERE oms.calls_type = %s LIMIT 1
-            """
-            cur.execute(query, (call_type,))
-            return cur.fetchone()
+            return self.config_cache.get_call_settings(cur, call_type)
         except Exception as e:
             self.logger.error(f"Error while getting rating settings {call_type}: {e}")
             return None
 
-    def get_number_for_call(self, cur, call_type, sleeptime):
+    def get_numbers_for_call(self, cur, call_type, sleeptime, limit=1):
         try:
-            query = """
-                SELECT `id`, `calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `uniqueid`, `recordingfile`
-                FROM `autodial_marks` 
-                WHERE `mark_type` = %s AND callback_status = 'NEW' AND NOW() > `calldate` + INTERVAL %s SECOND LIMIT 1
-            """
-            cur.execute(query, (call_type, sleeptime,))
-            return cur.fetchone()
+            if call_type in self.pending:
+                return self.pending[call_type].numbers(cur, sleeptime, limit)
+            status_clause, status_params = mark_status_filter(self.claims)
+            query = NUMBERS_FOR_CALL_SQL.format(status_clause=status_clause)
+            cur.execute(query, (call_type, *status_params, sleeptime, limit))
+            return list(cur.fetchall())
         except Exception as e:
             self.logger.error(f"Error while getting the number for rating {call_type}: {e}")
-            return None
+            return []
 
     def get_ivr_branch(self, cur, call_type, detail_information):
         try:
             if call_type == "incoming":
-                query = "SELECT mark_ivr_menu AS ivr_branch FROM `config_queue_callbacks` WHERE `queue_name` = %s"
-                cur.execute(query, (detail_information['queue'],))
-                result = cur.fetchone()
-                return result['ivr_branch'] if result else None
+                return self.config_cache.get_queue_ivr_branch(cur, detail_information['queue'])
 
             if call_type == "manual_out":
-                query = "SELECT queue_ivr_branch AS ivr_branch FROM `config_agent_marks` WHERE sip = %s"
-                cur.execute(query, (detail_information['operator_number'],))
-                result = cur.fetchone()
-                return result['ivr_branch'] if result else None
+                return self.config_cache.get_agent_ivr_branch(cur, detail_information['operator_number'])
 
         except Exception as e:
             self.logger.error(f"Error while getting the IVR branch for rating {call_type}: {e}")
             return None
 
 class Redial:
-    def __init__(self, call_process, logger, con, redials_timeout):
+    def __init__(self, call_process, logger, config_cache, redials_timeout, batch_mode=False, batch_size=50, claims=None):
         self.call_process = call_process
-        self.con = con
         self.logger = logger
+        self.config_cache = config_cache
         self.redials_timeout = redials_timeout
+        self.batch_mode = batch_mode
+        self.batch_size = batch_size
+        self.claims = claims
+        self.lock_name = 'autodial_marks_redial'
 
     def redial_handle_call(self, cur):
-        self.logger.debug(f"Mark redial is started")
-        detail_information = self.get_redial_number(cur)
+        self.logger.debug("Mark redial is started")
+        if not self.claims:
+            return self.dispatch_redials(cur)
+
+        # operator_marks has no claim columns, so only one worker runs redials at a time
+        if not self.claims.acquire_lock(cur, self.lock_name):
+            self.logger.debug("Redials are handled by another worker")
+            return 0
+        try:
+            return self.dispatch_redials(cur)
+        finally:
+            self.claims.release_lock(cur, self.lock_name)
+
+    def dispatch_redials(self, cur):
+        limit = self.batch_size if self.batch_mode else 1
+        detail_information = self.get_redial_numbers(cur, limit)
         if detail_information:
-            self.logger.info(f"Detail information for redial: {detail_information}")
-            updated_information = self.call_process.assign_operators_to_numbers(detail_information)
-            department_settings = self.get_department_settings(cur, detail_information['mark_type'])
-            ivr_branch = self.get_ivr_branch(cur, detail_information)
-            if ivr_branch:
-                uniqueid = self.get_call_uniqueid(cur, detail_information['evaluated_call_id'])
-                audio_filename = self.call_process.get_operator_audio_by_number(cur, detail_information['operator_number'], detail_information['mark_type'])
-                if updated_information is not None and department_settings is not None and ivr_branch is not None and uniqueid is not None:
-                    self.make_redial_call(cur, updated_information, department_settings, ivr_branch, uniqueid, audio_filename)
-                else:
+            self.logger.info("Detail information for redial: %s", self.logger.summary(detail_information, 'client_number'),
+                             call_type='redial', rows=len(detail_information))
+            departments = {}
+            for detail in detail_information:
+                department_settings = self.get_department_settings(cur, detail['mark_type'])
+                ivr_branch = self.get_ivr_branch(cur, detail)
+                if not ivr_branch:
+                    self.logger.error(f"Failed to get IVR branch for Redial where call type: {detail['mark_type']}")
+                    continue
+                uniqueid = self.get_call_uniqueid(cur, detail['evaluated_call_id'])
+                if department_settings is None or uniqueid is None:
                     self.logger.error("Failed to create redials file. One or more parameters are empty")
-            else:
-                self.logger.error(f"Failed to get IVR branch for Redial where call type: {detail_information['mark_type']}")
+                    continue
+                detail['ivr_branch'] = ivr_branch
+                detail['uniqueid'] = uniqueid['uniqueid']
+                detail['audio_filename'] = self.call_process.get_operator_audio_by_number(cur, detail['operator_number'], detail['mark_type'])
+                departments.setdefault(department_settings['dep_id'], (department_settings, []))[1].append(detail)
+
+            dispatched = 0
+            for department_settings, numbers in departments.values():
+                updated_information = self.call_process.assign_operators_to_numbers(numbers)
+                dispatched += self.make_redial_call(cur, updated_information, department_settings)
+            return dispatched
         else:
-            self.logger.debug(f"Detail information for Recal si null")
+            self.logger.debug("Detail information for Recal si null")
+        return 0
 
-    def get_redial_number(self, cur):
+    def get_redial_numbers(self, cur, limit=1):
         try:
-            query = """
-                SELECT `client_number`, `operator_number`, `date_callback`, `queue`, `evaluated_call_id`, `mark_type` 
-                FROM `operator_marks` 
-                WHERE `call_attempts` = 1 AND `callback_status` != 'INITED' 
-                AND `callback_status` != 'ANSWERED' AND NOW() > `date_callback` + INTERVAL %s SECOND LIMIT 1
-            """
-            cur.execute(query, (self.redials_timeout,))
-            return cur.fetchone()
+            cur.execute(REDIAL_NUMBERS_SQL, (self.redials_timeout, limit))
+            return list(cur.fetchall())
         except Exception as e:
             self.logger.error(f"Error while getting the number for callback: {e}")
-            return None
+            return []
 
     def get_department_settings(self, cur, call_type):
         try:
-            query = """
-                SELECT d.callerid, d.id AS dep_id
-                FROM operator_marks_setting oms
-                JOIN departaments d ON d.name = oms.dep_name
-                WHERE oms.calls_type = %s
-            """
-            cur.execute(query, (call_type,))
-            return cur.fetchone()
+            return self.config_cache.get_call_settings(cur, call_type)
         except Exception as e:
             self.logger.error(f"Error while getting the department settings during callback for rating '{call_type}': {e}")
             return None
@@ -321,21 +1142,13 @@ class Redial:
     def get_ivr_branch(self, cur, detail_information):
         try:
             if detail_information['mark_type'] == "incoming":
-                query = "SELECT mark_ivr_menu AS ivr_branch FROM `config_queue_callbacks` WHERE `queue_name` = %s"
-                cur.execute(query, (detail_information['queue'],))
-                result = cur.fetchone()
-                return result['ivr_branch'] if result else None
+                return self.config_cache.get_queue_ivr_branch(cur, detail_information['queue'])
 
             if detail_information['mark_type'] == "manual_out":
-                query = "SELECT queue_ivr_branch AS ivr_branch FROM `config_agent_marks` WHERE sip = %s"
-                cur.execute(query, (detail_information['operator_number'],))
-                result = cur.fetchone()
-                return result['ivr_branch'] if result else None
+                return self.config_cache.get_agent_ivr_branch(cur, detail_information['operator_number'])
 
             if detail_information['mark_type'] == 'last_call' or detail_information['mark_type'] == 'last_call_out':
-                query = "SELECT ivr_branch FROM `operator_marks_setting` WHERE calls_type = %s"
-                cur.execute(query, (detail_information['mark_type'],))
-                result = cur.fetchone()
+                result = self.config_cache.get_setting(cur, detail_information['mark_type'])
                 return result['ivr_branch'] if result else None
 
         except Exception as e:
@@ -344,107 +1157,311 @@ class Redial:
 
     def get_call_uniqueid(self, cur, evaluated_call_id):
         try:
-            query = "SELECT uniqueid FROM `autodial_marks` WHERE `id` = %s LIMIT 1"
-            cur.execute(query, (evaluated_call_id,))
+            cur.execute(CALL_UNIQUEID_SQL, (evaluated_call_id,))
             return cur.fetchone()
         except Exception as e:
             self.logger.error(f"Error while getting the unique call identifier during callback ID '{evaluated_call_id}': {e}")
             return None
 
-    def make_redial_call(self, cur, numbers, department_settings, ivr_branch, uniqueid, audio_filename):
-        free = calc_free_sim(cur, department_settings['dep_id'], True, self.logger)
-        if any(value > 0 for value in free.values()):
-            random.shuffle(self.call_process.operator_list)
-            local_operator_list = self.call_process.operator_list.copy()
-            if free['trunk_enable']:
-                local_operator_list.append('all_trunk')
-            for oper in local_operator_list:
-                if not numbers:
-                    self.logger.debug("No more numbers to process.")
-                    break
-
-                if oper in ['all', 'all_trunk']:
-                    selected_numbers = numbers[:free[oper]]
-                else:
-                    selected_numbers = [num for num in numbers if num['oper'] == oper][:free[oper]]
-
-                for number in selected_numbers:
-                    self.update_call(cur, number['evaluated_call_id'])
-                    self.call_process.make_call_file(department_settings['callerid'], number['client_number'], number['evaluated_call_id'], ivr_branch, uniqueid, audio_filename)
-                    numbers.remove(number)
+    def make_redial_call(self, cur, numbers, department_settings):
+        with self.call_process.dispatch_locks.hold(department_settings['dep_id'], 'redial'):
+            free = self.call_process.get_free_sim(cur, department_settings['dep_id'])
+            dispatched = 0
+            plan = []
+            if any(value > 0 for value in free.values()):
+                numbers, headroom = self.call_process.spool_monitor.admit(department_settings['callerid'], numbers)
+                plan = self.call_process.plan_dispatch(numbers, free)[:headroom]
+            batch = [number for _, number in plan]
+
+            if batch and self.update_calls(cur, [number['evaluated_call_id'] for number in batch]):
+                sent = set(self.call_process.make_call_files([
+                    (department_settings['callerid'], number['client_number'], number['evaluated_call_id'],
+                     number['ivr_branch'], number['uniqueid'], number['audio_filename'])
+                    for number in batch
+                ]))
+                if len(sent) < len(batch):
+                    self.restore_calls(cur, [number for number in batch if number['evaluated_call_id'] not in sent])
+                self.call_process.capacity.reserve(department_settings['dep_id'], [oper for oper, number in plan if number['evaluated_call_id'] in sent])
+                dispatched = len(sent)
+                for number in batch:
+                    if number['evaluated_call_id'] in sent:
+                        self.call_process.metrics.inc('autodial_redials_dispatched_total', mark_type=number['mark_type'], operator=number['oper'])
+            return dispatched
+
+    def update_calls(self, cur, evaluated_call_ids):
+        try:
+            query = REDIAL_INITED_SQL.format(placeholders=', '.join(['%s'] * len(evaluated_call_ids)))
+            cur.connection.begin()
+            cur.execute(query, evaluated_call_ids)
+            cur.connection.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Error while updating the call status with IDs {evaluated_call_ids}: {e}")
+            cur.connection.rollback()
+            return False
 
-    def update_call(self, cur, evaluated_call_id):
+    def restore_calls(self, cur, numbers):
         try:
-            query = "UPDATE `operator_marks` SET `callback_status` = 'INITED' WHERE `evaluated_call_id` = %s"
-            cur.execute(query, (evaluated_call_id,))
-            self.con.commit()
+            cur.connection.begin()
+            cur.executemany(REDIAL_RESTORE_SQL, self.restore_rows(numbers))
+            cur.connection.commit()
+            self.logger.warning(f"Redials not accepted by Asterisk, status restored: {[number['evaluated_call_id'] for number in numbers]}")
         except Exception as e:
-            self.logger.error(f"Error while updating the call status with ID '{evaluated_call_id}': {e}")
-            self.con.rollback() 
+            self.logger.error(f"Error while restoring the status of redials {[number['evaluated_call_id'] for number in numbers]}: {e}")
+            cur.connection.rollback()
+
+    def restore_rows(self, numbers):
+        return [(number['callback_status'], number['evaluated_call_id']) for number in numbers]
+
+class DispatchLocks:
+    # One lock per department around "read free SIMs -> dispatch". When several handlers wait for the
+    # same department the most urgent mark type goes first, then first come first served.
+    # Reentrant, so a handler holding its department can call into calc_free_and_process.
+    priorities = {'incoming': 0, 'manual_out': 1, 'redial': 2, 'last_call': 3, 'last_call_out': 3}
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.owners = {}
+        self.waiting = {}
+        self.tickets = itertools.count()
+
+    @contextmanager
+    def hold(self, dep_id, call_type):
+        self.acquire(dep_id, call_type)
+        try:
+            yield
+        finally:
+            self.release(dep_id)
+
+    def acquire(self, dep_id, call_type):
+        thread_id = threading.get_ident()
+        with self.condition:
+            owner = self.owners.get(dep_id)
+            if owner and owner[0] == thread_id:
+                self.owners[dep_id] = (thread_id, owner[1] + 1)
+                return
+
+            ticket = (self.priorities.get(call_type, len(self.priorities)), next(self.tickets))
+            waiters = self.waiting.setdefault(dep_id, [])
+            heapq.heappush(waiters, ticket)
+            while dep_id in self.owners or waiters[0] != ticket:
+                self.condition.wait()
+            heapq.heappop(waiters)
+            self.owners[dep_id] = (thread_id, 1)
+
+    def release(self, dep_id):
+        with self.condition:
+            thread_id, depth = self.owners[dep_id]
+            if depth > 1:
+                self.owners[dep_id] = (thread_id, depth - 1)
+            else:
+                del self.owners[dep_id]
+                self.condition.notify_all()
+
+class CapacityTracker:
+    # calc_free_sim per department, reused for `ttl` seconds by every handler. Slots spent on spooled call
+    # files are subtracted locally, because Asterisk takes a moment to pick a file up and occupy the SIM.
+    # On refresh a reservation is dropped once the real value shows it taken, or after `settle` seconds at most.
+    slots = ('mts', 'ks', 'life', 'all', 'all_trunk')
+
+    def __init__(self, logger, ttl=2, settle=5):
+        self.logger = logger
+        self.ttl = ttl
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.free = {}
+        self.fetched_at = {}
+        # dep_id -> slot -> deque of reservation times, oldest first
+        self.reserved = {}
+        self.hits = 0
+        self.refreshes = 0
+
+    def cached(self, dep_id):
+        # Free slots left after local reservations, or None when calc_free_sim has to run again
+        with self.lock:
+            fetched_at = self.fetched_at.get(dep_id)
+            if fetched_at is None or time.monotonic() - fetched_at >= self.ttl:
+                return None
+            self.hits += 1
+            return self.available(dep_id)
+
+    def refresh(self, dep_id, free):
+        now = time.monotonic()
+        with self.lock:
+            self.refreshes += 1
+            previous = self.free.get(dep_id, {})
+            for slot, reservations in self.reserved.get(dep_id, {}).items():
+                taken = max(previous.get(slot, 0) - free.get(slot, 0), 0)
+                while reservations and (taken > 0 or now - reservations[0] >= self.settle):
+                    reservations.popleft()
+                    taken -= 1
+                if reservations:
+                    self.logger.debug("Dep %s slot %s: %s reservations not yet visible in calc_free_sim", dep_id, slot, len(reservations))
+            self.free[dep_id] = dict(free)
+            self.fetched_at[dep_id] = now
+            return self.available(dep_id)
+
+    def available(self, dep_id):
+        free = dict(self.free[dep_id])
+        for slot, reservations in self.reserved.get(dep_id, {}).items():
+            free[slot] = max(free.get(slot, 0) - len(reservations), 0)
+        return free
+
+    def reserve(self, dep_id, slots):
+        # One entry per call file written, named after the plan_dispatch slot it took
+        now = time.monotonic()
+        with self.lock:
+            reserved = self.reserved.setdefault(dep_id, {})
+            for slot in slots:
+                reserved.setdefault(slot, deque()).append(now)
+
+    def invalidate(self, dep_id=None):
+        with self.lock:
+            if dep_id is None:
+                self.fetched_at.clear()
+            else:
+                self.fetched_at.pop(dep_id, None)
+
+    def collect_metrics(self, metrics):
+        with self.lock:
+            metrics.set('autodial_capacity_cache_hits', self.hits)
+            metrics.set('autodial_capacity_refreshes', self.refreshes)
+            for dep_id, reserved in self.reserved.items():
+                for slot in self.slots:
+                    metrics.set('autodial_capacity_reserved', len(reserved.get(slot, ())), dep_id=dep_id, slot=slot)
 
 class CallProcess:
-    def __init__(self, logger, con):
+    def __init__(self, logger, config_cache, operator_audio, operator_prefixes=None, metrics=None, capacity=None, spool_monitor=None,
+                 originator=None):
         self.logger = logger
-        self.con = con
-        self.operator_list = ['mts', 'ks', 'life', 'all']
+        self.config_cache = config_cache
+        self.operator_audio = operator_audio
+        self.operator_prefixes = operator_prefixes or OperatorPrefixes()
+        self.metrics = metrics or NullMetrics()
+        self.capacity = capacity or CapacityTracker(logger)
+        self.operator_list = ['mts', 'ks', 'life']
         self.call_file_dir = '/var/www/html/asterisk/call'
         self.asterisk_outgoing = '/var/spool/asterisk/outgoing'
+        self.spool_monitor = spool_monitor or SpoolMonitor(logger, self.asterisk_outgoing, self.operator_prefixes, self.metrics)
+        self.spool = SpoolWriter(self.logger, self.call_file_dir, self.asterisk_outgoing, metrics=self.metrics, monitor=self.spool_monitor)
+        # AmiOriginator when dispatch_backend = ami, call files otherwise
+        self.originator = originator
+        self.dispatch_locks = DispatchLocks()
+
+    def get_free_sim(self, cur, dep_id):
+        free = self.capacity.cached(dep_id)
+        if free is None:
+            with self.metrics.timer('autodial_calc_free_sim_seconds'):
+                free = self.capacity.refresh(dep_id, calc_free_sim(cur, dep_id, True, self.logger))
+        self.record_free_sim(dep_id, free)
+        return free
+
+    def spooled_slots(self, plan, dispatched):
+        # Slots of the planned numbers that reached Asterisk
+        dispatched_ids = {number['id'] for number in dispatched}
+        return [oper for oper, number in plan if number['id'] in dispatched_ids]
+
+    def record_free_sim(self, dep_id, free):
+        if self.metrics.enabled:
+            for slot in (*self.operator_list, 'all', 'all_trunk'):
+                self.metrics.set('autodial_free_sim', free.get(slot, 0), dep_id=dep_id, slot=slot)
+
+    def free_capacity(self, free):
+        capacity = sum(free.get(oper, 0) for oper in self.operator_list) + free.get('all', 0)
+        if free.get('trunk_enable'):
+            capacity += free.get('all_trunk', 0)
+        return capacity
+
+    def calc_free_and_process(self, numbers, cur, call_type, ivr_branch, dep_id, department_callerid, start_time, end_time, free=None):
+        # Free SIMs are read and spent under one lock, so concurrent handlers never hand out the same slots
+        with self.dispatch_locks.hold(dep_id, call_type):
+            return self.dispatch_to_free_sim(numbers, cur, call_type, ivr_branch, dep_id, department_callerid, start_time, end_time, free)
+
+    def dispatch_to_free_sim(self, numbers, cur, call_type, ivr_branch, dep_id, department_callerid, start_time, end_time, free):
+        if free is None:
+            free = self.get_free_sim(cur, dep_id)
+        self.logger.info("Free sim in dep %s: %s, numbers: %s", department_callerid, free, self.logger.summary(numbers, 'client_number'))
+        if not any(value > 0 for value in free.values()):
+            self.logger.warning(f"No free sim in dep {department_callerid}, for call type: {call_type}")
+            return 0
+
+        numbers, headroom = self.spool_monitor.admit(department_callerid, numbers)
+        plan = self.plan_dispatch(numbers, free)[:headroom]
+        selected = {}
+        for oper, number in plan:
+            selected.setdefault(oper, []).append(number['client_number'])
+        for oper, client_numbers in selected.items():
+            self.logger.debug("Selected numbers: %s for operator %s", self.logger.summary(client_numbers), oper)
+
+        dispatched = self.process_calls(cur, [number for _, number in plan], call_type, ivr_branch, department_callerid, start_time, end_time)
+        if dispatched:
+            self.capacity.reserve(dep_id, self.spooled_slots(plan, dispatched))
+        return len(dispatched)
+
+    def plan_dispatch(self, numbers, free):
+        # One pass to bucket numbers by operator, then each operator fills its own SIMs
+        # and whatever is left goes to the shared 'all' and 'all_trunk' slots in arrival order
+        buckets = {oper: [] for oper in self.operator_list}
+        for index, number in enumerate(numbers):
+            bucket = buckets.get(number['oper'])
+            if bucket is not None:
+                bucket.append(index)
+
+        taken = set()
+        plan = []
+        for oper in self.operator_list:
+            for index in buckets[oper][:max(free.get(oper, 0), 0)]:
+                taken.add(index)
+                plan.append((oper, numbers[index]))
+
+        leftovers = deque(number for index, number in enumerate(numbers) if index not in taken)
+        shared_slots = ['all', 'all_trunk'] if free.get('trunk_enable') else ['all']
+        for oper in shared_slots:
+            for _ in range(min(max(free.get(oper, 0), 0), len(leftovers))):
+                plan.append((oper, leftovers.popleft()))
+
+        if leftovers:
+            self.logger.debug("No free sim left for %s numbers", len(leftovers))
+        return plan
+
+    def process_calls(self, cur, numbers, call_type, ivr_branch, department_callerid, start_time, end_time):
+        # Returns the numbers whose call reached Asterisk
+        calls = []
+        for number in numbers:
+            number_ivr_branch = number.get('ivr_branch', ivr_branch)
+            if number_ivr_branch:
+                audio_filename = self.get_operator_audio_by_number(cur, number['operator_number'], call_type)
+                calls.append((number, number_ivr_branch, audio_filename))
+            else:
+                self.logger.error(f"IVR branch is null for call type: {call_type}")
 
-    def calc_free_and_process(self, numbers, cur, call_type, ivr_branch, dep_id, department_callerid, start_time, end_time):
-        free = calc_free_sim(cur, dep_id, True, self.logger)
-        self.logger.info(free)
-        self.logger.info(numbers)
-        if any(value > 0 for value in free.values()):
-            random.shuffle(self.operator_list)
-            local_operator_list = self.operator_list.copy()
-            if free['trunk_enable']:
-                local_operator_list.append('all_trunk')
-            for oper in local_operator_list:
-                if not numbers:
-                    self.logger.debug("No more numbers to process.")
-                    break
-
-                if oper in ['all', 'all_trunk']:
-                    selected_numbers = numbers[:free[oper]]
-                else:
-                    selected_numbers = [num for num in numbers if num['oper'] == oper][:free[oper]]
-
-                self.logger.debug(f"Selected numbers: {selected_numbers} for operator {oper}")
+        if not calls:
+            return []
 
-                for number in selected_numbers:
-                    self.process_call(cur, number, call_type, ivr_branch, department_callerid, start_time, end_time)
-                    numbers.remove(number)
-        else:
-            self.logger.warning(f"No free sim in dep {department_callerid}, for call type: {call_type}")
+        # Call files are only spooled once the whole batch is committed
+        if not self.save_calls(cur, [number for number, _, _ in calls], call_type, start_time, end_time):
+            self.logger.error(f"Failed to add calls to operator marks for call type: {call_type}, numbers: {[number['client_number'] for number, _, _ in calls]}")
+            return []
 
-    def process_call(self, cur, number, call_type, ivr_branch, department_callerid, start_time, end_time):
-        if ivr_branch:
-            audio_filename = self.get_operator_audio_by_number(cur, number['operator_number'], call_type)
-            success = self.add_call_to_operator_mark(cur, number, call_type)
-            if success:
-                self.update_call_status(cur, number, call_type, start_time, end_time)
-                self.make_call_file(department_callerid, number['client_number'], number['id'], ivr_branch, number['uniqueid'], audio_filename)
-            else:
-                self.logger.error(f"Failed to add call to operator mark for number: {number['operator_number']} and call type: {call_type}")
-        else:
-            self.logger.error(f"IVR branch is null for call type: {call_type}")
+        sent = set(self.make_call_files([
+            (department_callerid, number['client_number'], number['id'], number_ivr_branch, number['uniqueid'], audio_filename)
+            for number, number_ivr_branch, audio_filename in calls
+        ]))
+        dispatched = [number for number, _, _ in calls if number['id'] in sent]
+        if len(dispatched) < len(calls):
+            self.restore_calls(cur, [number for number, _, _ in calls if number['id'] not in sent], call_type)
+        for number in dispatched:
+            self.metrics.inc('autodial_callbacks_dispatched_total', mark_type=call_type, operator=number['oper'])
+        return dispatched
 
     def get_operator_audio_by_number(self, cur, operator_number, call_type):
         try:
-            cur.execute("SELECT say_fio FROM operator_marks_setting WHERE calls_type = %s", (call_type,))
-            settings = cur.fetchone()
+            settings = self.config_cache.get_setting(cur, call_type)
 
             if not settings or settings['say_fio'] != 1:
                 return None
 
-            cur.execute("SELECT audio_filename FROM operator_name_audio WHERE operator_number = %s LIMIT 1", (operator_number,))
-            audio_filename = cur.fetchone()
-
-            if audio_filename:
-                return audio_filename['audio_filename']
-            else:
-                self.logger.warning(f"Say_fio is enabled, but no audio filename found for operator number: '{operator_number}'")
-                return None
+            return self.operator_audio.get(cur, operator_number)
 
         except Exception as e:
             self.logger.error(f"Error while getting settings for call type {call_type} or audio file of the operator's name. Operator's number: '{operator_number}': {e}")
@@ -454,122 +1471,284 @@ class CallProcess:
         if isinstance(detail_information, dict):
             detail_information = [detail_information]
 
-        updated_information = []
-        for detail in detail_information:
-            client_number = detail['client_number']
-            if client_number.startswith(('+38066', '+38095', '+38050')):
-                oper = 'mts'
-            elif client_number.startswith(('+38067', '+38068', '+38096', '+38097', '+38098')):
-                oper = 'ks'
-            elif client_number.startswith(('+38063', '+38073', '+38093')):
-                oper = 'life'
-            else:
-                oper = 'unknown'
-
-            updated_detail = detail.copy()
-            updated_detail['oper'] = oper
-            updated_information.append(updated_detail)
+        # Tagged in place, the rows are not used anywhere else once they reach the dispatcher
+        opers = self.operator_prefixes.classify_many([detail['client_number'] for detail in detail_information])
+        for detail, oper in zip(detail_information, opers):
+            detail['oper'] = oper
 
-        return updated_information
+        return detail_information
 
-    def add_call_to_operator_mark(self, cur, number, call_type):
+    def save_calls(self, cur, numbers, call_type, start_time=None, end_time=None):
         try:
-            cur.execute("""
-                INSERT INTO `operator_marks` 
-                (`calldate`, `client_number`, `operator_number`, `billsec`, `queue`, `evaluated_call_id`, `mark_type`, `recordingfile`) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                number['calldate'], 
-                number['client_number'], 
-                number['operator_number'], 
-                number['billsec'], 
-                number['queue'], 
-                number['id'], 
-                call_type, 
-                number['recordingfile']
-            ))
-            self.con.commit()
+            cur.connection.begin()
+            self.add_calls_to_operator_marks(cur, numbers, call_type)
+            self.update_calls_status(cur, numbers, call_type, start_time, end_time)
+            with self.metrics.timer('autodial_db_commit_seconds'):
+                cur.connection.commit()
             return True
         except Exception as e:
-            self.logger.error(f"Error while inserting a record into 'operator_marks' for rating '{call_type}': {e}")
-            self.con.rollback()
+            self.logger.error(f"Error while saving calls for rating '{call_type}', changes rolled back: {e}")
+            cur.connection.rollback()
             return False
 
-    def update_call_status(self, cur, number, call_type, start_time=None, end_time=None):
-        try:
-            if call_type == 'last_call':
-                query = """
-                    UPDATE `autodial_marks` 
-                    SET `callback_status` = 'PROCESSED'
-                    WHERE `mark_type` = 'last_call' 
-                    AND calldate BETWEEN %s AND %s 
-                    AND `client_number` = %s
-                """
-                params = (start_time, end_time, number['client_number'])
-            elif call_type == 'last_call_out':
-                query = """
-                    UPDATE `autodial_marks` 
-                    SET `callback_status` = 'PROCESSED'  
-                    WHERE `mark_type` = 'last_call_out' 
-                    AND calldate BETWEEN %s AND %s 
-                    AND `client_number` = %s
-                """
-                params = (start_time, end_time, number['client_number'])
-            elif call_type == 'incoming':
-                query = """
-                    UPDATE `autodial_marks` 
-                    SET `callback_status` = 'PROCESSED'
-                    WHERE `mark_type` = 'incoming' 
-                    AND `client_number` = %s
-                """
-                params = (number['client_number'],)
-            else:  # 'manual_out'
-                query = """
-                    UPDATE `autodial_marks` 
-                    SET `callback_status` = 'PROCESSED'  
-                    WHERE `mark_type` = 'manual_out' 
-                    AND `client_number` = %s
-                """
-                params = (number['client_number'],)
-
-            cur.execute(query, params)
-            self.con.commit()
+    def restore_calls(self, cur, numbers, call_type):
+        # Undoes save_calls for calls Asterisk did not take, so the marks are dispatched again
+        try:
+            cur.connection.begin()
+            for statement in self.restore_statements(numbers, call_type):
+                cur.execute(*statement)
+            cur.connection.commit()
+            self.logger.warning(f"Calls not accepted by Asterisk for call type: {call_type}, marks back to NEW: {[number['client_number'] for number in numbers]}")
         except Exception as e:
-            self.logger.error(f"Error while updating a record in 'autodial_marks' for rating '{call_type}': {e}")
-            self.con.rollback()
+            self.logger.error(f"Error while restoring marks for rating '{call_type}': {e}")
+            cur.connection.rollback()
+
+    def restore_statements(self, numbers, call_type):
+        mark_ids = [number['id'] for number in numbers]
+        placeholders = ', '.join(['%s'] * len(mark_ids))
+        return [
+            (UNDISPATCHED_OPERATOR_MARKS_SQL.format(placeholders=placeholders), [call_type] + mark_ids),
+            (UNDISPATCHED_MARKS_SQL.format(placeholders=placeholders), mark_ids),
+        ]
+
+    def add_calls_to_operator_marks(self, cur, numbers, call_type):
+        cur.executemany(INSERT_OPERATOR_MARKS_SQL, self.operator_marks_rows(numbers, call_type))
+
+    def operator_marks_rows(self, numbers, call_type):
+        return [(
+            number['calldate'], 
+            number['client_number'], 
+            number['operator_number'], 
+            number['billsec'], 
+            number['queue'], 
+            number['id'], 
+            call_type, 
+            number['recordingfile']
+        ) for number in numbers]
+
+    def update_calls_status(self, cur, numbers, call_type, start_time=None, end_time=None):
+        cur.execute(*self.calls_status_update(numbers, call_type, start_time, end_time))
+
+    def calls_status_update(self, numbers, call_type, start_time=None, end_time=None):
+        client_numbers = list({number['client_number'] for number in numbers})
+        placeholders = ', '.join(['%s'] * len(client_numbers))
+        if call_type in ('last_call', 'last_call_out'):
+            return LAST_CALL_PROCESSED_SQL.format(placeholders=placeholders), [call_type, start_time, end_time] + client_numbers
+        # 'incoming', 'manual_out'
+        return CALL_PROCESSED_SQL.format(placeholders=placeholders), [call_type] + client_numbers
+
+    def call_fields(self, dep_cid, number, callid, queue_ivr_branch, uniqueid_number_evaluated, audio_filename=None):
+        # Shared by the call file and the AMI Originate backend
+        return [
+            ('Channel', f"Local/{number}@from-autodial-marks"),
+            ('MaxRetries', 0),
+            ('RetryTime', 60),
+            ('WaitTime', 60),
+            ('Context', 'ivr-marks'),
+            ('Extension', 's'),
+            ('Priority', 1),
+            ('Callerid', dep_cid),
+            ('Setvar', f"callback_callid={callid}"),
+            ('Setvar', f"queue_branch={queue_ivr_branch}"),
+            ('Setvar', f"uniqueid_number_evaluated={uniqueid_number_evaluated}"),
+            ('Setvar', f"operator_name_audio={audio_filename}"),
+        ]
+
+    def build_call_file(self, dep_cid, number, callid, queue_ivr_branch, uniqueid_number_evaluated, audio_filename=None):
+        fields = self.call_fields(dep_cid, number, callid, queue_ivr_branch, uniqueid_number_evaluated, audio_filename)
+        body = ''.join(f"{key}: {value}\n" for key, value in fields)
+        return f"callback_ocinka-{number}.call", body
 
     def make_call_file(self, dep_cid, number, callid, queue_ivr_branch, uniqueid_number_evaluated, audio_filename=None):
-        body = f'''Channel: Local/{number}@from-autodial-marks
-MaxRetries: 0
-RetryTime: 60
-WaitTime: 60
-Context: ivr-marks
-Extension: s
-Priority: 1
-Callerid: {dep_cid}
-Setvar: callback_callid={callid}
-Setvar: queue_branch={queue_ivr_branch}
-Setvar: uniqueid_number_evaluated={uniqueid_number_evaluated}
-Setvar: operator_name_audio={audio_filename}
-    '''
-        try:
-            file_name = f"callback_ocinka-{number}.call"
-            call_file_path = os.path.join(self.call_file_dir, file_name)
-
-            with open(call_file_path, "w") as call_file:
-                call_file.write(body)
+        return self.make_call_files([(dep_cid, number, callid, queue_ivr_branch, uniqueid_number_evaluated, audio_filename)])
 
-            self.logger.info(f"Created file {file_name}")
+    def make_call_files(self, calls):
+        # Returns the callids that reached Asterisk: Originate queued, or call file moved into the spool
+        if self.originator:
+            return self.originator.originate_batch([(call[2], self.call_fields(*call)) for call in calls])
+        files = [self.build_call_file(*call) for call in calls]
+        return self.published_callids(calls, files, self.spool.write_batch(files))
 
-            os.chown(call_file_path, pwd.getpwnam('asterisk').pw_uid, grp.getgrnam('asterisk').gr_gid)
+    def published_callids(self, calls, files, published):
+        published = set(published)
+        return [call[2] for call, (file_name, _) in zip(calls, files) if file_name in published]
 
-            time.sleep(0.1)
+class SpoolWriter:
+    def __init__(self, logger, staging_dir, outgoing_dir, owner='asterisk', fsync=True, metrics=None, monitor=None):
+        self.logger = logger
+        self.staging_dir = staging_dir
+        self.outgoing_dir = outgoing_dir
+        self.owner = owner
+        self.fsync = fsync
+        self.metrics = metrics or NullMetrics()
+        self.monitor = monitor
+        self.owner_ids = None
+
+    def get_owner_ids(self):
+        if self.owner_ids is None:
+            try:
+                self.owner_ids = (pwd.getpwnam(self.owner).pw_uid, grp.getgrnam(self.owner).gr_gid)
+            except KeyError as e:
+                self.logger.warning(f"Call files will keep the current owner, user or group '{self.owner}' not found: {e}")
+                self.owner_ids = (-1, -1)
+        return self.owner_ids
+
+    def stage(self, file_name, body):
+        path = os.path.join(self.staging_dir, file_name)
+        data = memoryview(body.encode())
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fchown(fd, *self.get_owner_ids())
+            if self.fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        return path
+
+    def write_batch(self, files):
+        # Stage the whole batch first, then publish with rename so Asterisk never sees a partial file
+        with self.metrics.timer('autodial_spool_write_seconds'):
+            return self.publish(files)
+
+    def publish(self, files):
+        staged = []
+        for file_name, body in files:
+            try:
+                staged.append((file_name, body, self.stage(file_name, body)))
+            except OSError as e:
+                self.logger.error(f"Failed to create call file {file_name}: {e}")
+
+        # Names of the files that reached the spool
+        written = []
+        for file_name, body, path in staged:
+            try:
+                os.rename(path, os.path.join(self.outgoing_dir, file_name))
+                self.logger.info("Created file %s", file_name)
+                written.append(file_name)
+                if self.monitor:
+                    self.monitor.published(file_name, body)
+            except OSError as e:
+                self.logger.error(f"Failed to move call file {file_name} to the spool: {e}")
+        return written
+
+class SpoolMonitor:
+    # Call files still waiting in the Asterisk outgoing dir, rescanned at most every `scan_interval` seconds.
+    # Asterisk keeps a file there until the call is over, so the depth is what is queued or dialing right now.
+    # Files are counted per department (their Callerid line) and per operator of the number in the name;
+    # files this process writes count at once, before the next scan sees them.
+    file_prefix = 'callback_ocinka-'
+
+    def __init__(self, logger, outgoing_dir, operator_prefixes=None, metrics=None, scan_interval=1, max_pending=0, max_depth=0):
+        self.logger = logger
+        self.outgoing_dir = outgoing_dir
+        self.operator_prefixes = operator_prefixes or OperatorPrefixes()
+        self.metrics = metrics or NullMetrics()
+        self.scan_interval = scan_interval
+        # 0 disables a limit: max_pending is per department, max_depth for the whole dir
+        self.max_pending = max_pending
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        # file name -> (callerid, oper)
+        self.files = {}
+        self.scanned_at = None
+
+    def file_name(self, client_number):
+        return f"{self.file_prefix}{client_number}.call"
+
+    def describe(self, file_name, lines):
+        callerid = None
+        for line in lines:
+            key, _, value = line.partition(':')
+            if key.strip() == 'Callerid':
+                callerid = value.strip()
+                break
+        if file_name.startswith(self.file_prefix) and file_name.endswith('.call'):
+            oper = self.operator_prefixes.classify(file_name[len(self.file_prefix):-len('.call')])
+        else:
+            oper = 'unknown'
+        return callerid, oper
 
-            destination_path = os.path.join(self.asterisk_outgoing, file_name)
-            os.rename(call_file_path, destination_path)
+    def due(self):
+        return self.scanned_at is None or time.monotonic() - self.scanned_at >= self.scan_interval
 
-        except Exception as e:
-            self.logger.error(f"Failed to create call file for number {number}: {e}")
+    def scan(self):
+        # Only files not seen before are opened, the rest keep what was read from them
+        with self.lock:
+            known = dict(self.files)
+        files = {}
+        try:
+            with os.scandir(self.outgoing_dir) as entries:
+                for entry in entries:
+                    if entry.name in known:
+                        files[entry.name] = known[entry.name]
+                        continue
+                    try:
+                        with open(entry.path) as f:
+                            files[entry.name] = self.describe(entry.name, f)
+                    except (FileNotFoundError, IsADirectoryError):
+                        # Picked up and removed by Asterisk between scandir and open
+                        continue
+        except OSError as e:
+            self.logger.error(f"Failed to scan the spool {self.outgoing_dir}: {e}")
+            return
+        with self.lock:
+            self.files = files
+            self.scanned_at = time.monotonic()
+
+    def published(self, file_name, body):
+        described = self.describe(file_name, body.splitlines())
+        with self.lock:
+            self.files[file_name] = described
+
+    def admit(self, callerid, numbers):
+        # Numbers to dispatch and how many of them the spool takes (None when unlimited). A number with a call
+        # file already waiting is held back, writing another would overwrite it; its mark stays for a later tick
+        if self.due():
+            self.scan()
+        admitted = []
+        queued = []
+        seen = set()
+        with self.lock:
+            for number in numbers:
+                file_name = self.file_name(number['client_number'])
+                if file_name in self.files or file_name in seen:
+                    queued.append(number['client_number'])
+                else:
+                    seen.add(file_name)
+                    admitted.append(number)
+            headroom = self.headroom(callerid)
+
+        if queued:
+            self.logger.info("Already queued in the spool, held back: %s", self.logger.summary(queued))
+            self.metrics.inc('autodial_spool_duplicates_total', len(queued))
+        if headroom is not None and headroom < len(admitted):
+            self.logger.warning(f"Spool is full for dep {callerid}, dispatching {headroom} of {len(admitted)} numbers")
+            self.metrics.inc('autodial_spool_throttled_total', len(admitted) - headroom)
+        return admitted, headroom
+
+    def headroom(self, callerid):
+        limits = []
+        if self.max_depth:
+            limits.append(self.max_depth - len(self.files))
+        if self.max_pending:
+            limits.append(self.max_pending - sum(1 for file_callerid, _ in self.files.values() if file_callerid == callerid))
+        return max(min(limits), 0) if limits else None
+
+    def pending(self):
+        # (callerid, oper) -> files waiting
+        with self.lock:
+            counts = {}
+            for key in self.files.values():
+                counts[key] = counts.get(key, 0) + 1
+            return counts
+
+    def collect_metrics(self, metrics):
+        pending = self.pending()
+        metrics.set('autodial_spool_depth', sum(pending.values()))
+        for (callerid, oper), count in pending.items():
+            metrics.set('autodial_spool_pending', count, callerid=callerid or 'unknown', oper=oper)
 
 if __name__ == "__main__":
     autodialer = Autodialer()
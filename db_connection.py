@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+import pymysql
+
+# Retry and health check settings live next to the credentials:
+# [mysql]
+# connect_retries = 5
+# connect_backoff = 1        ; seconds before the second attempt, doubled up to connect_max_backoff
+# connect_max_backoff = 30
+# ping_interval = 5          ; an idle connection is pinged at most this often
+connection_errors = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+class ConnectionManager:
+    # Owns one connection and revives it in place, so objects holding a reference keep working after a reconnect
+    def __init__(self, logger, retries=5, backoff=1, max_backoff=30, ping_interval=5, **connect_args):
+        self.logger = logger
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ping_interval = ping_interval
+        self.connect_args = connect_args
+        self.con = None
+        self.checked_at = None
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0
+
+    @classmethod
+    def from_config(cls, config, logger, section='mysql', **connect_args):
+        args = {
+            'host': config[section]['host'],
+            'port': config.getint(section, 'port', fallback=3306),
+            'user': config[section]['user'],
+            'password': config[section]['password'],
+            'database': config[section]['database'],
+            'charset': 'utf8',
+            'cursorclass': pymysql.cursors.DictCursor,
+        }
+        args.update(connect_args)
+        return cls(
+            logger,
+            retries=config.getint(section, 'connect_retries', fallback=5),
+            backoff=config.getfloat(section, 'connect_backoff', fallback=1),
+            max_backoff=config.getfloat(section, 'connect_max_backoff', fallback=30),
+            ping_interval=config.getfloat(section, 'ping_interval', fallback=5),
+            **args
+        )
+
+    def connection(self):
+        # Healthy connection or an exception once the retries are spent
+        now = time.monotonic()
+        if self.con is None:
+            self.con = self.retry(lambda: pymysql.connect(**self.connect_args))
+            self.connects += 1
+        elif not self.con.open or self.checked_at is None or now - self.checked_at >= self.ping_interval:
+            try:
+                self.con.ping(reconnect=False)
+            except pymysql.err.Error as e:
+                self.logger.warning(f"MySQL connection lost, reconnecting: {e}")
+                self.retry(lambda: self.con.ping(reconnect=True))
+                self.connects += 1
+                self.reconnects += 1
+                self.logger.info(f"MySQL connection restored, reconnects so far: {self.reconnects}")
+        self.checked_at = now
+        return self.con
+
+    def retry(self, action):
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                return action()
+            except connection_errors as e:
+                self.failures += 1
+                if attempt == self.retries:
+                    self.logger.error(f"MySQL connection failed after {attempt} attempts: {e}")
+                    raise
+                self.logger.warning(f"MySQL connection attempt {attempt}/{self.retries} failed, retrying in {delay}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def invalidate(self):
+        # The next connection() call pings instead of trusting the last check
+        self.checked_at = None
+
+    def close(self):
+        if self.con is not None and self.con.open:
+            self.con.close()
+        self.con = None
+
+    def collect_metrics(self, metrics):
+        metrics.set('autodial_db_connects', self.connects)
+        metrics.set('autodial_db_reconnects', self.reconnects)
+        metrics.set('autodial_db_connect_failures', self.failures)
+
+class ConnectionPool:
+    # Connections for work running in parallel, each checked by its own manager and created on first demand
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.managers = []
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.managers) < self.size:
+                manager = self.factory()
+                self.managers.append(manager)
+                return manager
+        return self.idle.get()
+
+    @contextmanager
+    def connection(self):
+        manager = self.acquire()
+        try:
+            yield manager.connection()
+        except connection_errors:
+            manager.invalidate()
+            raise
+        finally:
+            self.idle.put(manager)
+
+    @property
+    def reconnects(self):
+        return sum(manager.reconnects for manager in self.managers)
+
+    def collect_metrics(self, metrics):
+        metrics.set('autodial_db_pool_size', len(self.managers))
+        metrics.set('autodial_db_pool_idle', self.idle.qsize())
+        metrics.set('autodial_db_pool_reconnects', self.reconnects)
+
+    def close(self):
+        for manager in self.managers:
+            manager.close()
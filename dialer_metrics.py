@@ -0,0 +1,228 @@
+import os
+import re
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Prometheus text exposition for the dialer. Enabled with:
+# [metrics]
+# enabled = true
+# http_port = 9105            ; served on http_host (127.0.0.1 by default) at /metrics
+# textfile = /var/lib/node_exporter/textfile/autodial_marks.prom   ; for the node_exporter textfile collector
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+statement_words = re.compile(r'\s*(\w*)')
+statement_words_bytes = re.compile(rb'\s*(\w*)')
+
+def statement_label(query):
+    # First word of the statement. pymysql's executemany hands bulk INSERTs to execute() as a bytearray,
+    # the regex reads its head without copying the whole batch
+    if isinstance(query, (bytes, bytearray)):
+        return statement_words_bytes.match(query).group(1).decode(errors='replace').upper()
+    return statement_words.match(query).group(1).upper()
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+class NullMetrics:
+    # Stand-in used when metrics are disabled: every call is a no-op and the cursor class is left untouched
+    enabled = False
+    null_timer = NullTimer()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self.null_timer
+
+    def total(self, name):
+        return 0
+
+    def register(self, collector):
+        pass
+
+    def cursor_class(self, base):
+        return base
+
+    def start(self):
+        pass
+
+    def export(self):
+        pass
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, logger, http_host='127.0.0.1', http_port=None, textfile=None):
+        self.logger = logger
+        self.http_host = http_host
+        self.http_port = http_port
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.types = {}
+        self.values = {}
+        self.collectors = []
+        self.server = None
+
+    @classmethod
+    def from_config(cls, config, logger, section='metrics'):
+        if not config.getboolean(section, 'enabled', fallback=False):
+            return NullMetrics()
+        return cls(
+            logger,
+            http_host=config.get(section, 'http_host', fallback='127.0.0.1'),
+            http_port=config.getint(section, 'http_port', fallback=None),
+            textfile=config.get(section, 'textfile', fallback=None)
+        )
+
+    def key(self, name, kind, labels):
+        self.types.setdefault(name, kind)
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            key = self.key(name, 'counter', labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.key(name, 'gauge', labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        # Summary without quantiles: _count and _sum are enough for rate() based averages
+        with self.lock:
+            key = self.key(name, 'summary', labels)
+            count, total = self.values.get(key, (0, 0.0))
+            self.values[key] = (count + 1, total + seconds)
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def total(self, name):
+        # Sum over all label sets; for timers that is the number of observations
+        with self.lock:
+            values = [value for (key, _), value in self.values.items() if key == name]
+        if self.types.get(name) == 'summary':
+            return sum(count for count, _ in values)
+        return sum(values)
+
+    def register(self, collector):
+        # Callables run at scrape time, for values that are cheaper to read than to push on every change
+        self.collectors.append(collector)
+
+    def cursor_class(self, base):
+        metrics = self
+
+        class InstrumentedCursor(base):
+            # pymysql's executemany goes through execute for every statement it sends, so this counts round trips
+            def execute(self, query, args=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, args)
+                finally:
+                    # The query has already reached the server, a metrics failure must not turn it into an error
+                    try:
+                        metrics.observe('autodial_db_query_seconds', time.perf_counter() - started,
+                                        statement=statement_label(query))
+                    except Exception as e:
+                        metrics.logger.error(f"Query metrics failed: {e}")
+
+        return InstrumentedCursor
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                self.logger.error(f"Metrics collector {collector} failed: {e}")
+
+        with self.lock:
+            values = sorted(self.values.items())
+            types = dict(self.types)
+
+        lines = []
+        declared = set()
+        for (name, labels), value in values:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {name} {types[name]}")
+            if types[name] == 'summary':
+                count, total = value
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            else:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        if not self.http_port or self.server:
+            return
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.http_host, self.http_port), MetricsHandler)
+        except OSError as e:
+            self.logger.error(f"Failed to start metrics endpoint on {self.http_host}:{self.http_port}: {e}")
+            return
+        threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+        self.logger.info(f"Metrics are served on http://{self.http_host}:{self.http_port}/metrics")
+
+    def export(self):
+        # Written through a temporary file, the textfile collector must never read a half written file
+        if not self.textfile:
+            return
+        tmp_path = self.textfile + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp_path, self.textfile)
+        except OSError as e:
+            self.logger.error(f"Failed to write metrics to {self.textfile}: {e}")
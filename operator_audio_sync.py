@@ -0,0 +1,123 @@
+import os
+import sys
+import argparse
+import configparser
+import pymysql
+
+# Upserts rely on one row per operator:
+#   ALTER TABLE operator_name_audio ADD UNIQUE KEY uq_operator_number (operator_number);
+sounds_dir = '/var/lib/asterisk/sounds'
+
+def connect(config_path='/opt/pydialer/config.ini'):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    return pymysql.connect(
+        host=config['mysql']['host'],
+        port=config.getint('mysql', 'port', fallback=3306),
+        user=config['mysql']['user'],
+        password=config['mysql']['password'],
+        database=config['mysql']['database'],
+        charset='utf8',
+        cursorclass=pymysql.cursors.DictCursor
+    )
+
+def prompt_dir(sounds_dir=sounds_dir, prefix=''):
+    # Where Asterisk looks for '<prefix>/<operator number>'
+    return os.path.realpath(os.path.join(sounds_dir, prefix))
+
+def mappings_from_outputs(output_paths, prefix=''):
+    # Converted prompts are named after the operator number: 101.wav -> ('101', '<prefix>/101')
+    mappings = {}
+    for output_path in output_paths:
+        operator_number = os.path.splitext(os.path.basename(output_path))[0]
+        mappings[operator_number] = os.path.join(prefix, operator_number) if prefix else operator_number
+    return sorted(mappings.items())
+
+def has_operator_key(con):
+    # Without a unique key on operator_number alone ON DUPLICATE KEY never fires and every sync adds rows
+    with con.cursor() as cur:
+        cur.execute("SHOW INDEX FROM operator_name_audio WHERE Non_unique = 0")
+        rows = cur.fetchall()
+    keys = {}
+    for row in rows:
+        keys.setdefault(row['Key_name'], []).append(row['Column_name'])
+    return ['operator_number'] in keys.values()
+
+def upsert_operator_audio(con, mappings):
+    # All mappings land in one transaction, either the whole batch is visible to the dialer or none of it
+    if not mappings:
+        return 0
+    if not has_operator_key(con):
+        raise RuntimeError("operator_name_audio has no unique key on operator_number, refusing to upsert: "
+                           "ALTER TABLE operator_name_audio ADD UNIQUE KEY uq_operator_number (operator_number)")
+    try:
+        with con.cursor() as cur:
+            cur.executemany("""
+                INSERT INTO operator_name_audio (operator_number, audio_filename)
+                VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE audio_filename = VALUES(audio_filename)
+            """, mappings)
+        con.commit()
+        return len(mappings)
+    except Exception:
+        con.rollback()
+        raise
+
+def missing_prompts(audio_filenames, sounds_dir=sounds_dir):
+    # Asterisk plays prompts without an extension, so any file with a matching stem counts.
+    # Each directory is listed once, however many prompts point into it
+    available = {}
+    missing = set()
+    for audio_filename in audio_filenames:
+        directory, name = os.path.split(os.path.join(sounds_dir, audio_filename))
+        if directory not in available:
+            try:
+                available[directory] = {os.path.splitext(entry.name)[0] for entry in os.scandir(directory) if entry.is_file()}
+            except FileNotFoundError:
+                available[directory] = set()
+        if name not in available[directory]:
+            missing.add(audio_filename)
+    return missing
+
+def find_missing_prompts(con, sounds_dir=sounds_dir):
+    # Rows the dialer can already emit whose prompt is not on disk
+    with con.cursor() as cur:
+        cur.execute("SELECT operator_number, audio_filename FROM operator_name_audio WHERE audio_filename IS NOT NULL AND audio_filename != ''")
+        rows = cur.fetchall()
+    missing = missing_prompts((row['audio_filename'] for row in rows), sounds_dir)
+    return [row for row in rows if row['audio_filename'] in missing]
+
+def sync_operator_audio(con, output_paths, prefix='', sounds_dir=sounds_dir):
+    # New mappings are checked before the upsert: a prompt Asterisk cannot find is never written to the table.
+    # The outputs have to be the files Asterisk plays, otherwise a row could point at an older prompt of the same name
+    target = prompt_dir(sounds_dir, prefix)
+    outside = [output_path for output_path in output_paths if os.path.realpath(os.path.dirname(output_path)) != target]
+    if outside:
+        raise RuntimeError(f"{len(outside)} converted prompts are not in {target}, first: {outside[0]}")
+    mappings = mappings_from_outputs(output_paths, prefix)
+    missing = missing_prompts((audio_filename for _, audio_filename in mappings), sounds_dir)
+    for operator_number, audio_filename in mappings:
+        if audio_filename in missing:
+            print(f"Skipped operator {operator_number}: '{audio_filename}' not found in {sounds_dir}")
+
+    updated = upsert_operator_audio(con, [mapping for mapping in mappings if mapping[1] not in missing])
+    print(f"operator_name_audio: {updated} mappings upserted, {len(mappings) - updated} skipped")
+
+    stale = find_missing_prompts(con, sounds_dir)
+    for row in stale:
+        print(f"Missing prompt for operator {row['operator_number']}: '{row['audio_filename']}' not found in {sounds_dir}")
+    return updated, stale
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that every operator_name_audio prompt exists in the Asterisk sounds dir")
+    parser.add_argument('--config', default='/opt/pydialer/config.ini')
+    parser.add_argument('--sounds-dir', default=sounds_dir)
+    args = parser.parse_args()
+
+    con = connect(args.config)
+    with con:
+        missing = find_missing_prompts(con, args.sounds_dir)
+    for row in missing:
+        print(f"Missing prompt for operator {row['operator_number']}: '{row['audio_filename']}' not found in {args.sounds_dir}")
+    print(f"Missing prompts: {len(missing)}")
+    sys.exit(1 if missing else 0)
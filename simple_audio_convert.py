@@ -1,31 +1,260 @@
-from pydub import AudioSegment
 import os
+import json
+import wave
+import hashlib
+import argparse
+import warnings
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
-def convert_audio(input_folder, output_folder):
-    # Проверяем, существует ли выходная папка, если нет - создаем ее
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+try:
+    from pydub import AudioSegment
+except ImportError:
+    AudioSegment = None
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop
+except ImportError:  # убран из стандартной библиотеки в Python 3.13
+    audioop = None
+
+SUPPORTED_FORMATS = ('.mp3', '.ogg', '.flv', '.wav', '.m4a', '.aac')  # Добавьте другие поддерживаемые форматы по необходимости
+MANIFEST_NAME = '.convert_manifest.json'
+TARGET_RATE = 8000
+CHUNK_FRAMES = 64 * 1024
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConvertManifest:
+    # Что и из какого исходника уже сконвертировано в выходной папке: размер, mtime и sha1 исходника
+    def __init__(self, output_folder):
+        self.path = os.path.join(output_folder, MANIFEST_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, input_path, output_path):
+        entry = self.entries.get(os.path.basename(output_path))
+        if not entry or entry['source'] != os.path.abspath(input_path) or not os.path.exists(output_path):
+            return False
+
+        stat = os.stat(input_path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns == entry['mtime']:
+            return True
+
+        # mtime поменялся (копирование, touch) - сверяем содержимое
+        if file_hash(input_path) != entry['sha1']:
+            return False
+        entry['mtime'] = stat.st_mtime_ns
+        return True
+
+    def record(self, input_path, output_path, signature):
+        self.entries[os.path.basename(output_path)] = dict(signature, source=os.path.abspath(input_path))
+
+    def prune(self, output_folder):
+        # Удаляем выходные файлы, исходники которых исчезли
+        removed = []
+        for name, entry in list(self.entries.items()):
+            if not os.path.exists(entry['source']):
+                output_path = os.path.join(output_folder, name)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                del self.entries[name]
+                removed.append(output_path)
+        return removed
+
+    def save(self):
+        # Пишем через временный файл, чтобы падение не оставило битый манифест
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+def convert_pydub(input_path, output_path):
+    if AudioSegment is None:
+        raise RuntimeError("pydub is not installed, use --engine ffmpeg")
+
+    # Загружаем аудиофайл
+    audio = AudioSegment.from_file(input_path)
+
+    # Преобразуем аудиофайл: моно, 8000 Гц, 16 бит
+    audio = audio.set_frame_rate(TARGET_RATE).set_channels(1).set_sample_width(2)
+
+    # Сохраняем аудиофайл в формате WAV
+    audio.export(output_path, format='wav')
+
+def convert_ffmpeg(input_path, output_path):
+    # Один процесс ffmpeg декодирует и ресемплирует, сырой PCM читается из stdout кусками,
+    # поэтому память не зависит от длины записи. Заголовок WAV пишет модуль wave.
+    # stderr идет во временный файл: непрочитанный пайп при многословном ffmpeg заблокировал бы обе стороны
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', input_path,
+               '-ac', '1', '-ar', str(TARGET_RATE), '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1']
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr) as process:
+            with wave.open(output_path, 'wb') as output:
+                output.setnchannels(1)
+                output.setsampwidth(2)
+                output.setframerate(TARGET_RATE)
+                for chunk in iter(lambda: process.stdout.read(CHUNK_FRAMES * 2), b''):
+                    output.writeframesraw(chunk)
+        if process.returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors='replace').strip()
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {message}")
 
-    # Проходим по всем файлам в входной папке
-    for filename in os.listdir(input_folder):
-        if filename.endswith(('.mp3', '.ogg', '.flv', '.wav', '.m4a', '.aac')):  # Добавьте другие поддерживаемые форматы по необходимости
-            # Определяем путь к входному и выходному файлу
+def convert_wav(input_path, output_path):
+    # WAV на входе пересчитываем без внешних процессов, остальные форматы отдаем ffmpeg
+    if not input_path.lower().endswith('.wav'):
+        return convert_ffmpeg(input_path, output_path)
+    if audioop is None:
+        raise RuntimeError("audioop is not available in this Python, use --engine ffmpeg")
+
+    try:
+        source = wave.open(input_path, 'rb')
+    except wave.Error:
+        # wave читает только PCM, µ-law, A-law и GSM уходят в ffmpeg как прочие форматы
+        return convert_ffmpeg(input_path, output_path)
+
+    with source, wave.open(output_path, 'wb') as output:
+        channels = source.getnchannels()
+        width = source.getsampwidth()
+        rate = source.getframerate()
+        output.setnchannels(1)
+        output.setsampwidth(2)
+        output.setframerate(TARGET_RATE)
+
+        state = None
+        while True:
+            frames = source.readframes(CHUNK_FRAMES)
+            if not frames:
+                break
+            if width == 1:
+                frames = audioop.bias(frames, 1, -128)  # 8-битный WAV беззнаковый
+            frames = audioop.lin2lin(frames, width, 2)
+            if channels == 2:
+                frames = audioop.tomono(frames, 2, 0.5, 0.5)
+            elif channels > 2:
+                raise ValueError(f"{channels} channel WAV is not supported, use --engine ffmpeg")
+            if rate != TARGET_RATE:
+                frames, state = audioop.ratecv(frames, 2, 1, rate, TARGET_RATE, state)
+            output.writeframesraw(frames)
+
+ENGINES = {
+    'pydub': convert_pydub,
+    'ffmpeg': convert_ffmpeg,
+    'wav': convert_wav,
+}
+
+def convert_file(input_path, output_path, engine='pydub'):
+    # Пишем во временный файл и переименовываем, чтобы недописанный WAV не попал в выходную папку
+    tmp_path = output_path + '.part'
+    try:
+        ENGINES[engine](input_path, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+def source_signature(input_path):
+    stat = os.stat(input_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': file_hash(input_path)}
+
+def safe_convert(task):
+    # Ошибка одного файла не должна останавливать всю пачку.
+    # Подпись исходника снимается до конвертации, чтобы правка во время работы не потерялась
+    input_path, output_path, with_signature, engine = task
+    try:
+        signature = source_signature(input_path) if with_signature else None
+        convert_file(input_path, output_path, engine)
+        return input_path, output_path, None, signature
+    except Exception as e:
+        return input_path, output_path, str(e), None
+
+def list_audio_files(input_folder, output_folder):
+    tasks = []
+    for filename in sorted(os.listdir(input_folder)):
+        if filename.endswith(SUPPORTED_FORMATS):
             input_path = os.path.join(input_folder, filename)
             output_path = os.path.join(output_folder, os.path.splitext(filename)[0] + '.wav')
-            
-            # Загружаем аудиофайл
-            audio = AudioSegment.from_file(input_path)
-            
-            # Преобразуем аудиофайл
-            audio = audio.set_frame_rate(8000).set_channels(1).set_sample_width(2)
-            
-            # Сохраняем аудиофайл в формате WAV
-            audio.export(output_path, format='wav')
-            print(f"Конвертировано: {output_path}")
-
-# Укажите путь к вашей входной и выходной папкам
-input_folder = '/home/VK/prizvicha'
-output_folder = '/home/VK/prizvichanew/'
-
-convert_audio(input_folder, output_folder)
+            tasks.append((input_path, output_path))
+    return tasks
+
+def print_progress(done, total, input_path, output_path, error):
+    if error:
+        print(f"[{done}/{total}] Ошибка: {input_path}: {error}")
+    else:
+        print(f"[{done}/{total}] Конвертировано: {output_path}")
+
+def convert_files(tasks, workers=None, progress=print_progress, manifest=None, save_every=50, engine='pydub'):
+    # workers=1 - конвертация в текущем процессе, иначе пул процессов (по умолчанию по числу ядер).
+    # Результаты и прогресс приходят в порядке задач.
+    # С манифестом неизменившиеся исходники пропускаются, а сам манифест сохраняется
+    # каждые save_every файлов, так что после падения работа продолжится с места остановки.
+    tasks = list(tasks)
+    if manifest is not None:
+        pending = [(input_path, output_path) for input_path, output_path in tasks
+                   if not (os.path.exists(input_path) and manifest.is_current(input_path, output_path))]
+        if len(pending) < len(tasks):
+            print(f"Без изменений, пропущено: {len(tasks) - len(pending)}")
+        tasks = pending
+
+    jobs = [(input_path, output_path, manifest is not None, engine) for input_path, output_path in tasks]
+    results = []
+    if workers == 1:
+        outcomes = map(safe_convert, jobs)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        outcomes = executor.map(safe_convert, jobs)
+
+    try:
+        for done, (input_path, output_path, error, signature) in enumerate(outcomes, 1):
+            if progress:
+                progress(done, len(jobs), input_path, output_path, error)
+            results.append((input_path, output_path, error))
+            if manifest is not None and not error:
+                manifest.record(input_path, output_path, signature)
+                if done % save_every == 0:
+                    manifest.save()
+    finally:
+        if executor:
+            executor.shutdown()
+        if manifest is not None:
+            manifest.save()
+    return results
+
+def convert_audio(input_folder, output_folder, workers=None, progress=print_progress, incremental=False, engine='pydub'):
+    # Проверяем, существует ли выходная папка, если нет - создаем ее
+    os.makedirs(output_folder, exist_ok=True)
+
+    manifest = None
+    if incremental:
+        manifest = ConvertManifest(output_folder)
+        for output_path in manifest.prune(output_folder):
+            print(f"Удалено (нет исходника): {output_path}")
+    return convert_files(list_audio_files(input_folder, output_folder), workers, progress, manifest, engine=engine)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Конвертация аудио в WAV 8000 Гц, моно, 16 бит")
+    parser.add_argument('input_folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--workers', type=int, default=None, help="число процессов, 1 - без пула")
+    parser.add_argument('--incremental', action='store_true', help=f"пропускать неизменившиеся файлы по манифесту {MANIFEST_NAME}")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='pydub',
+                        help="pydub - как раньше, ffmpeg - потоковый процесс ffmpeg, wav - WAV без внешних процессов")
+    args = parser.parse_args()
 
+    results = convert_audio(args.input_folder, args.output_folder, args.workers, incremental=args.incremental, engine=args.engine)
+    failed = sum(1 for _, _, error in results if error)
+    print(f"Готово: {len(results) - failed}, ошибок: {failed}")
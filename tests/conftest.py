@@ -0,0 +1,48 @@
+import sys
+import types
+import logging
+
+# autodial_marks_oop imports pymysql and the deployment-only helpers package at module level. The code under
+# test never reaches the database or calc_free_sim, so stand-ins are installed when the real ones are missing.
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+try:
+    import pymysql
+except ImportError:
+    class MySQLError(Exception):
+        pass
+
+    class Error(MySQLError):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class InterfaceError(Error):
+        pass
+
+    def connect(**kwargs):
+        raise OperationalError("pymysql is not installed")
+
+    err = stub_module('pymysql.err', MySQLError=MySQLError, Error=Error, OperationalError=OperationalError,
+                      InterfaceError=InterfaceError)
+    cursors = stub_module('pymysql.cursors', Cursor=object, DictCursor=type('DictCursor', (object,), {}))
+    stub_module('pymysql', err=err, cursors=cursors, connect=connect, MySQLError=MySQLError, Error=Error,
+                OperationalError=OperationalError, InterfaceError=InterfaceError)
+
+try:
+    import helpers.calc_free
+    import helpers.create_logger
+except ImportError:
+    def calc_free_sim(cur, dep_id, print_log, logger):
+        raise RuntimeError("helpers.calc_free is not installed")
+
+    helpers = stub_module('helpers')
+    helpers.__path__ = []
+    helpers.calc_free = stub_module('helpers.calc_free', calc_free_sim=calc_free_sim)
+    helpers.create_logger = stub_module('helpers.create_logger', create_logger=logging.getLogger)
@@ -0,0 +1,53 @@
+import logging
+
+from dialer_metrics import Metrics, statement_label
+
+class FakeCursor:
+    # Same shape as pymysql's Cursor: a bulk INSERT ... VALUES in executemany is rendered into one
+    # bytearray and sent through execute(), anything else goes through execute() row by row
+    def __init__(self):
+        self.sent = []
+
+    def execute(self, query, args=None):
+        self.sent.append(query)
+        return 1
+
+    def executemany(self, query, args):
+        if query.lstrip().upper().startswith('INSERT') and 'VALUES' in query.upper():
+            head, values = query.split('VALUES', 1)
+            sql = bytearray(f"{head}VALUES ".encode())
+            sql += b','.join((values.strip() % tuple(repr(value) for value in row)).encode() for row in args)
+            return self.execute(sql)
+        return sum(self.execute(query, row) for row in args)
+
+def statements(metrics):
+    return {dict(labels)['statement']: value[0] for (name, labels), value in metrics.values.items()
+            if name == 'autodial_db_query_seconds'}
+
+def test_statement_label():
+    assert statement_label("\n    SELECT * FROM t") == 'SELECT'
+    assert statement_label("update t set a = 1") == 'UPDATE'
+    assert statement_label(bytearray(b"  INSERT INTO t VALUES (1),(2)")) == 'INSERT'
+    assert statement_label(b"DELETE FROM t") == 'DELETE'
+    assert statement_label("") == ''
+
+def test_executemany_bulk_insert_is_counted():
+    metrics = Metrics(logging.getLogger('test_dialer_metrics'))
+    cursor = metrics.cursor_class(FakeCursor)()
+
+    assert cursor.executemany("INSERT INTO operator_marks (a, b) VALUES (%s, %s)", [(1, 2), (3, 4)]) == 1
+    assert isinstance(cursor.sent[0], bytearray)
+    cursor.executemany("UPDATE autodial_marks SET a = %s", [(1,), (2,)])
+    cursor.execute("SELECT 1")
+
+    assert statements(metrics) == {'INSERT': 1, 'UPDATE': 2, 'SELECT': 1}
+
+def test_metrics_failure_does_not_fail_the_query(monkeypatch):
+    metrics = Metrics(logging.getLogger('test_dialer_metrics'))
+    cursor = metrics.cursor_class(FakeCursor)()
+
+    def broken(*args, **labels):
+        raise TypeError('broken')
+    monkeypatch.setattr(metrics, 'observe', broken)
+
+    assert cursor.execute("SELECT 1") == 1
@@ -0,0 +1,67 @@
+import logging
+import pytest
+
+from autodial_marks_oop import CallProcess, Logger, SpoolMonitor
+
+def numbers(*opers):
+    return [{'id': index, 'client_number': f"+380000000{index:03d}", 'oper': oper} for index, oper in enumerate(opers)]
+
+def free_sim(**slots):
+    free = {'mts': 0, 'ks': 0, 'life': 0, 'all': 0, 'all_trunk': 0, 'trunk_enable': False}
+    free.update(slots)
+    return free
+
+def planned(plan):
+    return [(oper, number['client_number'][-3:]) for oper, number in plan]
+
+@pytest.fixture
+def logger():
+    logger = Logger(logging.getLogger('test_plan_dispatch'), False, console=False)
+    yield logger
+    logger.close()
+
+@pytest.fixture
+def call_process(logger):
+    call_process = CallProcess(None, None, None)
+    call_process.logger = logger
+    return call_process
+
+def test_operator_slots_are_filled_before_all(call_process):
+    plan = call_process.plan_dispatch(numbers('mts', 'mts', 'ks', 'mts'), free_sim(mts=1, all=2))
+    assert planned(plan) == [('mts', '000'), ('all', '001'), ('all', '002')]
+
+def test_each_operator_uses_only_its_own_slots(call_process):
+    plan = call_process.plan_dispatch(numbers('life', 'ks', 'mts', 'ks'), free_sim(mts=1, ks=1, life=1))
+    assert planned(plan) == [('mts', '002'), ('ks', '001'), ('life', '000')]
+
+def test_trunk_slots_only_when_enabled(call_process):
+    batch = numbers('mts', 'ks', 'life')
+    assert call_process.plan_dispatch(batch, free_sim(all=1, all_trunk=5)) == [('all', batch[0])]
+    plan = call_process.plan_dispatch(batch, free_sim(all=1, all_trunk=5, trunk_enable=True))
+    assert planned(plan) == [('all', '000'), ('all_trunk', '001'), ('all_trunk', '002')]
+
+def test_unknown_operators_only_take_shared_slots(call_process):
+    plan = call_process.plan_dispatch(numbers('unknown', 'unknown', 'unknown'), free_sim(mts=5, ks=5, life=5, all=1, all_trunk=1, trunk_enable=True))
+    assert planned(plan) == [('all', '000'), ('all_trunk', '001')]
+
+def test_negative_and_missing_slots_count_as_zero(call_process):
+    batch = numbers('mts', 'ks', 'life')
+    assert call_process.plan_dispatch(batch, {'mts': -2, 'all': -1}) == []
+    assert planned(call_process.plan_dispatch(batch, {'ks': 1})) == [('ks', '001')]
+
+def test_every_number_is_planned_at_most_once(call_process):
+    batch = numbers('mts', 'ks', 'life', 'unknown', 'mts')
+    plan = call_process.plan_dispatch(batch, free_sim(mts=5, ks=5, life=5, all=5, all_trunk=5, trunk_enable=True))
+    assert sorted(id(number) for _, number in plan) == sorted(id(number) for number in batch)
+
+def test_spool_headroom_cuts_the_plan(call_process, logger, tmp_path):
+    # Two call files are already waiting and the spool takes three, so one of four planned numbers is dispatched
+    call_process.spool_monitor = SpoolMonitor(logger, str(tmp_path), max_depth=3)
+    for name in ('a.call', 'b.call'):
+        (tmp_path / name).write_text('Callerid: 0800\n')
+    dispatched = []
+    call_process.process_calls = lambda cur, batch, *args: dispatched.extend(batch) or batch
+
+    batch = numbers('mts', 'ks', 'life', 'unknown')
+    assert call_process.dispatch_to_free_sim(batch, None, 'incoming', 'support', 1, '0800', None, None, free_sim(mts=1, ks=1, life=1, all=1)) == 1
+    assert dispatched == [batch[0]]